@@ -0,0 +1,253 @@
+#!/usr/bin/env python2
+"""
+Offline benchmarks of gmusicfs.
+
+The filesystem is driven through its FUSE operations, without mounting it,
+against a synthetic library (see fake.py). Run from the repository root:
+
+    python -m benchmarks.bench --tracks 20000 --latency 0.05 --bandwidth 2000000
+"""
+
+import os
+import sys
+import stat
+import time
+import random
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+
+from fuse import fuse_file_info
+from gmusicfs import gmusicfs
+
+from . import fake
+
+log = logging.getLogger('gmusicfs.benchmarks')
+
+READ_SIZE = 128 * 1024  # Like the kernel with big_writes, or a player
+READERS = 4  # Concurrent readers of a track
+
+
+class Benchmark(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.results = []  # (name, value, unit)
+        self.library = fake.Library(tracks=args.tracks, track_size=args.track_size)
+        self.server = fake.StreamServer(self.library, latency=args.latency,
+                                        bandwidth=args.bandwidth)
+        self.library.set_base_url(self.server.base_url)
+        fake.Mobileclient.library = self.library
+        fake.Mobileclient.base_url = self.server.base_url
+        fake.Mobileclient.api_latency = args.api_latency
+        gmusicfs.GoogleMusicAPI = fake.Mobileclient
+        self.cache_dir = tempfile.mkdtemp(prefix='gmusicfs-bench-')
+        self.fs = None
+
+    def report(self, name, value, unit):
+        self.results.append((name, value, unit))
+        print '{:<32} {:>12.3f} {}'.format(name, value, unit)
+        sys.stdout.flush()
+
+    def mount(self, name):
+        """Create the filesystem, start loading it like FUSE does once
+        mounted, and report how long the mount and the load took"""
+        start = time.time()
+        fs = gmusicfs.GMusicFS('/bench', username='bench', password='bench',
+                               true_file_size=self.args.true_file_size,
+                               cache_dir=self.cache_dir)
+        fs.init('/bench')
+        self.report('mount, ' + name, time.time() - start, 's')
+        fs.library.wait()
+        self.report('library loaded, ' + name, time.time() - start, 's')
+        return fs
+
+    def run(self):
+        self.server.start()
+        try:
+            self.bench_startup()
+            self.bench_walk()
+            self.bench_reads()
+        finally:
+            if self.fs:
+                self.fs.cleanup()
+            self.server.stop()
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.report('peak memory', rss / 1024.0, 'MiB')
+
+    def bench_startup(self):
+        fs = self.mount('full scan')
+        for thread in threading.enumerate():
+            if thread.name == 'sync':
+                thread.join()
+        fs.cleanup()
+        self.fs = self.mount('from snapshot')
+
+    def bench_walk(self):
+        """List every directory and stat every entry of the tree"""
+        fs = self.fs
+        dirs = ['/artists']
+        listed = stated = 0
+        start = time.time()
+        while dirs:
+            path = dirs.pop()
+            names = fs('readdir', path, None)
+            listed += 1
+            for name in names:
+                if name in ('.', '..'):
+                    continue
+                child = path + '/' + name
+                st = fs('getattr', child)
+                stated += 1
+                if stat.S_ISDIR(st['st_mode']):
+                    dirs.append(child)
+        elapsed = time.time() - start
+        self.report('walk', elapsed, 's')
+        self.report('readdir + getattr', (listed + stated) / elapsed, 'ops/s')
+
+        paths = [child for child in self.__tracks(fs)]
+        start = time.time()
+        for i in range(self.args.getattrs):
+            fs('getattr', paths[i % len(paths)])
+        self.report('getattr, warm', self.args.getattrs / (time.time() - start), 'ops/s')
+
+    def __tracks(self, fs, count=None):
+        """Paths of the first tracks in the tree"""
+        found = []
+        for artist in sorted(fs('readdir', '/artists', None))[2:]:
+            artist_path = '/artists/' + artist
+            for album in sorted(fs('readdir', artist_path, None))[2:]:
+                album_path = artist_path + '/' + album
+                for name in sorted(fs('readdir', album_path, None))[2:]:
+                    if name.endswith('.mp3'):
+                        found.append(album_path + '/' + name)
+                if count and len(found) >= count:
+                    return found[:count]
+        return found
+
+    def __content(self, fs, path):
+        """The bytes a track file must read as: its tag, then its audio"""
+        track = fs.library.paths.lookup(path)
+        return track.render_tag() + fake.audio_data(track.id, self.library.track_size)
+
+    def __check(self, path, content, offset, data):
+        if data != content[offset:offset + len(data)]:
+            raise AssertionError('Wrong data read from {} at offset {}'.format(path, offset))
+
+    def __read_all(self, path, content, first=None):
+        """Read a whole track sequentially, checking its bytes, and return
+        its size. first(), if given, is called after the first read."""
+        fs = self.fs
+        fi = fuse_file_info(flags=os.O_RDONLY)
+        fs('open', path, fi)
+        offset = 0
+        try:
+            while True:
+                data = fs('read', path, READ_SIZE, offset, fi)
+                if not data:
+                    break
+                self.__check(path, content, offset, data)
+                offset += len(data)
+                if first:
+                    first()
+                    first = None
+        finally:
+            fs('release', path, fi)
+        if offset != len(content):
+            raise AssertionError('Read {} bytes of {}, not {}'.format(offset, path, len(content)))
+        return offset
+
+    def bench_reads(self):
+        fs = self.fs
+        tracks = self.__tracks(fs, 3)
+        random.shuffle(tracks)
+
+        # Time to first byte and sequential throughput of an uncached track:
+        path = tracks[0]
+        content = self.__content(fs, path)
+        start = time.time()
+        first = lambda: self.report('time to first byte', (time.time() - start) * 1000, 'ms')
+        size = self.__read_all(path, content, first)
+        self.report('sequential read', size / (time.time() - start) / 1024**2, 'MiB/s')
+
+        # The same track again, from the cache:
+        start = time.time()
+        size = self.__read_all(path, content)
+        self.report('sequential read, cached', size / (time.time() - start) / 1024**2, 'MiB/s')
+
+        # Seeks in another uncached track:
+        path = tracks[1]
+        content = self.__content(fs, path)
+        fi = fuse_file_info(flags=os.O_RDONLY)
+        fs('open', path, fi)
+        latencies = []
+        for i in range(self.args.seeks):
+            offset = random.randrange(0, len(content) - READ_SIZE)
+            start = time.time()
+            data = fs('read', path, READ_SIZE, offset, fi)
+            latencies.append(time.time() - start)
+            if len(data) != READ_SIZE:
+                raise AssertionError('Short read of {} at offset {}'.format(path, offset))
+            self.__check(path, content, offset, data)
+        fs('release', path, fi)
+        latencies.sort()
+        self.report('seek latency, mean', sum(latencies) / len(latencies) * 1000, 'ms')
+        self.report('seek latency, p95', latencies[int(len(latencies) * 0.95)] * 1000, 'ms')
+
+        # Readers of one uncached track at once, sharing its stream session:
+        path = tracks[2]
+        content = self.__content(fs, path)
+        errors = []
+        def read():
+            try:
+                self.__read_all(path, content)
+            except Exception as e:
+                errors.append(e)
+        readers = [threading.Thread(target=read) for i in range(READERS)]
+        sent = self.server.bytes_sent
+        start = time.time()
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        elapsed = time.time() - start
+        if errors:
+            raise errors[0]
+        self.report('concurrent reads, {} readers'.format(READERS),
+                    READERS * len(content) / elapsed / 1024**2, 'MiB/s')
+        self.report('downloaded per track read', (self.server.bytes_sent - sent) /
+                    float(self.library.track_size), 'x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GMusicFS offline benchmarks')
+    parser.add_argument('--tracks', help='Tracks in the library (default: %(default)s)',
+                        default=2000, type=int)
+    parser.add_argument('--track-size', help='Bytes of audio per track (default: %(default)s)',
+                        default=4 * 1024**2, type=int, dest='track_size')
+    parser.add_argument('--latency', help='Latency of the stream server, in seconds'
+                        ' (default: %(default)s)', default=0.02, type=float)
+    parser.add_argument('--bandwidth', help='Bandwidth of each stream, in bytes per second,'
+                        ' 0 for no limit (default: %(default)s)', default=4 * 1024**2, type=int)
+    parser.add_argument('--api-latency', help='Latency of the API calls, in seconds'
+                        ' (default: %(default)s)', default=0.05, type=float, dest='api_latency')
+    parser.add_argument('--getattrs', help='getattr calls on warm entries (default: %(default)s)',
+                        default=100000, type=int)
+    parser.add_argument('--seeks', help='Random reads (default: %(default)s)',
+                        default=50, type=int)
+    parser.add_argument('-t', '--truefilesize', help='Mount with exact file sizes',
+                        action='store_true', dest='true_file_size')
+    parser.add_argument('-v', '--verbose', help='Show the gmusicfs logs',
+                        action='store_true')
+    args = parser.parse_args()
+
+    logging.getLogger('gmusicfs').setLevel(logging.INFO if args.verbose else logging.WARNING)
+    logging.getLogger('fuse').setLevel(logging.WARNING)
+    Benchmark(args).run()
+
+if __name__ == '__main__':
+    main()
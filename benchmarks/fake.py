@@ -0,0 +1,213 @@
+"""
+Offline stand-ins for Google Music: a synthetic library served by a fake
+Mobileclient, and a local HTTP server for the audio streams and album art,
+with configurable latency and bandwidth.
+"""
+
+import re
+import time
+import random
+import struct
+import hashlib
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+
+RANGE_REGEX = re.compile(r'bytes=(\d+)-(\d*)')
+WRITE_BLOCK = 16 * 1024
+PAGE_SIZE = 1000  # Tracks per page of get_all_songs(incremental=True)
+AUDIO_BLOCK = 4096
+
+
+def audio_data(track_id, size):
+    """Deterministic audio bytes of a track. Every block of AUDIO_BLOCK
+    bytes starts with its number, so bytes read at the wrong offset differ."""
+    seed = hashlib.sha1(track_id).digest()
+    filler = (seed * (AUDIO_BLOCK // len(seed) + 1))[:AUDIO_BLOCK - 4]
+    blocks = (size + AUDIO_BLOCK - 1) // AUDIO_BLOCK
+    return ''.join(struct.pack('>I', i) + filler for i in range(blocks))[:size]
+
+
+class Library(object):
+    """A generated library: artists with albums of tracks, and playlists"""
+
+    def __init__(self, tracks=1000, tracks_per_album=12, albums_per_artist=3,
+                 playlists=10, track_size=4 * 1024**2, seed=0):
+        rand = random.Random(seed)
+        self.track_size = track_size
+        self.tracks = []
+        self.albums = {}  # album id -> tracks
+        for i in range(tracks):
+            album = i // tracks_per_album
+            artist = album // albums_per_artist
+            # Some names are not ASCII, to check they can be looked up:
+            accent = u' Caf\xe9' if artist % 5 == 4 else u''
+            track = {
+                'id': 'track-{:08d}'.format(i),
+                'storeId': 'T{:026d}'.format(i),  # Other ids than in the library
+                'nid': 'T{:026d}'.format(i),
+                'title': u'Track {}'.format(i),
+                'trackNumber': i % tracks_per_album + 1,
+                'discNumber': 1,
+                'year': 1970 + album % 50,
+                'album': u'Album {}{}'.format(album, accent),
+                'albumId': 'album-{:06d}'.format(album),
+                'artist': u'Artist {}{}'.format(artist, accent),
+                'artistId': ['artist-{:06d}'.format(artist)],
+                'genre': rand.choice([u'Rock', u'Jazz', u'Pop', u'Classical', u'Electronic',
+                                       u'Chanson fran\xe7aise']),
+                'estimatedSize': str(track_size),
+                'creationTimestamp': str(int(time.time() - rand.randint(0, 10**8)) * 10**6),
+                'recentTimestamp': str(int(time.time()) * 10**6),
+                'albumArtRef': [{'url': '/art/{}.jpg'.format(album % 50)}],
+            }
+            self.tracks.append(track)
+            self.albums.setdefault(track['albumId'], []).append(track)
+        self.playlists = []
+        for i in range(playlists):
+            entries = rand.sample(self.tracks, min(50, len(self.tracks)))
+            self.playlists.append({
+                'id': 'playlist-{:04d}'.format(i),
+                'name': u'Playlist {}'.format(i),
+                'tracks': [{'trackId': track['id']} for track in entries],
+            })
+
+    def set_base_url(self, base_url):
+        """Make the album art references point to the stream server"""
+        for track in self.tracks:
+            ref = track['albumArtRef'][0]
+            ref['url'] = base_url + ref['url'][ref['url'].index('/art/'):]
+
+
+class Mobileclient(object):
+    """Replaces gmusicapi.Mobileclient, serving a Library. Every call sleeps
+    api_latency seconds first, like a round trip to Google would."""
+
+    FROM_MAC_ADDRESS = object()
+
+    library = None  # Set before the filesystem is created
+    base_url = None
+    api_latency = 0.0
+
+    def __init__(self, debug_logging=False):
+        self.calls = {}
+
+    def __call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        time.sleep(self.api_latency)
+
+    def login(self, username, password, device_id):
+        self.__call('login')
+        return True
+
+    def get_all_songs(self, incremental=False, include_deleted=None, updated_after=None):
+        self.__call('get_all_songs')
+        if updated_after is not None:
+            tracks = []  # Nothing changed
+        else:
+            tracks = [dict(track) for track in self.library.tracks]
+        if incremental:
+            return self.__pages(tracks)
+        return tracks
+
+    def __pages(self, tracks):
+        for start in range(0, len(tracks), PAGE_SIZE):
+            if start:
+                time.sleep(self.api_latency)
+            yield tracks[start:start + PAGE_SIZE]
+
+    def get_all_user_playlist_contents(self):
+        self.__call('get_all_user_playlist_contents')
+        return [dict(pl) for pl in self.library.playlists]
+
+    def get_album_info(self, album_id):
+        self.__call('get_album_info')
+        tracks = []
+        for track in self.library.albums.get(album_id, []):
+            track = dict(track)
+            del track['id']  # Only the store ids, like Google Music
+            tracks.append(track)
+        return {'albumId': album_id, 'tracks': tracks}
+
+    def get_stream_url(self, track_id):
+        self.__call('get_stream_url')
+        return '{}/audio/{}?expire={}'.format(self.base_url, track_id, int(time.time()) + 3600)
+
+
+class StreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+        path = urlparse.urlparse(self.path).path
+        if path.startswith('/audio/'):
+            data = audio_data(path[len('/audio/'):], server.library.track_size)
+        elif path.startswith('/art/'):
+            data = audio_data(path, server.art_size)
+        else:
+            self.send_error(404)
+            return
+        m = RANGE_REGEX.match(self.headers.get('Range') or '')
+        if m:
+            start = int(m.group(1))
+            end = min(int(m.group(2) or len(data) - 1), len(data) - 1)
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(len(data)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+            data = data[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        server.count(len(data))
+        for pos in range(0, len(data), WRITE_BLOCK):
+            block = data[pos:pos + WRITE_BLOCK]
+            if server.bandwidth:
+                time.sleep(float(len(block)) / server.bandwidth)
+            self.wfile.write(block)
+
+
+class StreamServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local server of the audio and art of a Library. latency is added to
+    every request, and each response is throttled to bandwidth bytes per
+    second (0 for no limit)."""
+
+    daemon_threads = True
+
+    def __init__(self, library, latency=0.0, bandwidth=0, art_size=64 * 1024):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StreamHandler)
+        self.library = library
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.art_size = art_size
+        self.requests = 0
+        self.bytes_sent = 0
+        self.__lock = threading.Lock()
+        self.__thread = threading.Thread(target=self.serve_forever, name='stream-server')
+        self.__thread.daemon = True
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_port)
+
+    def count(self, length):
+        with self.__lock:
+            self.requests += 1
+            self.bytes_sent += length
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,414 @@
+"""
+Persistent, size-capped on-disk cache for gmusicfs.
+
+Audio streams are split in fixed size chunks stored as
+<cache dir>/<track id>/<chunk index>, so partially played tracks are kept
+too. Once the cache grows over its byte budget, the least recently used
+chunks are evicted. Chunks written by another process sharing the cache
+directory, like gmusicfs-pin, are picked up when first looked for. Smaller blobs, like rendered tags and album art, go in
+a FileCache.
+"""
+
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger('gmusicfs.cache')
+
+CHUNK_SIZE = 256 * 1024
+LENGTH_FILE = 'length'
+
+
+def make_dirs(path):
+    """os.makedirs, which another writer may do at the same time"""
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def write_file(path, data):
+    """Write a file at once: readers never see it partly written, even
+    when another thread or process writes it at the same time"""
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+class AudioCache(object):
+    """Chunked audio cache keyed by track id, with LRU eviction"""
+
+    def __init__(self, path, max_size):
+        self.__path = path
+        self.__max_size = max_size
+        self.__lock = threading.Lock()
+        self.__chunks = OrderedDict()  # (track id, index) -> size, oldest first
+        self.__size = 0
+        self.hits = self.misses = 0
+        if not os.path.isdir(self.__path):
+            os.makedirs(self.__path)
+        self.__scan()
+
+    @property
+    def path(self):
+        return self.__path
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def max_size(self):
+        return self.__max_size
+
+    def __scan(self):
+        """Rebuild the LRU order from the chunks left by previous mounts,
+        deleting the leftovers of interrupted writes"""
+        found = []
+        for track_id in os.listdir(self.__path):
+            track_dir = os.path.join(self.__path, track_id)
+            if not os.path.isdir(track_dir):
+                continue
+            names = os.listdir(track_dir)
+            length = self.length(track_id)
+            for name in names[:]:
+                path = os.path.join(track_dir, name)
+                if name.isdigit():
+                    st = os.stat(path)
+                    if self.__complete_chunk(int(name), st.st_size, length):
+                        found.append((st.st_mtime, track_id, int(name), st.st_size))
+                        continue
+                elif not name.endswith('.tmp'):
+                    continue
+                log.info("Deleting {} from the audio cache".format(path))
+                os.unlink(path)
+                names.remove(name)
+            if not names:
+                os.rmdir(track_dir)
+        found.sort()
+        for mtime, track_id, index, size in found:
+            self.__chunks[(track_id, index)] = size
+            self.__size += size
+        log.info("Audio cache: {} chunks, {} bytes in {}".format(
+            len(self.__chunks), self.__size, self.__path))
+        with self.__lock:
+            self.__evict()
+
+    def __chunk_path(self, track_id, index):
+        return os.path.join(self.__path, track_id, str(index))
+
+    def __complete_chunk(self, index, size, length):
+        """Tell if a chunk of size bytes is whole: all of them are
+        CHUNK_SIZE bytes long, but the last one of the track"""
+        return size == CHUNK_SIZE or (
+            length is not None and 0 < size < CHUNK_SIZE and index * CHUNK_SIZE + size == length)
+
+    def __adopt(self, track_id, index):
+        """Index a chunk stored since the scan by another process, returns
+        whether it was found"""
+        try:
+            size = os.path.getsize(self.__chunk_path(track_id, index))
+        except OSError:
+            return False
+        with self.__lock:
+            key = (track_id, index)
+            if key not in self.__chunks:
+                self.__chunks[key] = size
+                self.__size += size
+                self.__evict()
+            return key in self.__chunks
+
+    def has(self, track_id, index):
+        return (track_id, index) in self.__chunks or self.__adopt(track_id, index)
+
+    def get(self, track_id, index):
+        """Return a cached chunk, or None when it is not in the cache"""
+        key = (track_id, index)
+        if key not in self.__chunks:
+            self.__adopt(track_id, index)
+        with self.__lock:
+            if key not in self.__chunks:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Mark as most recently used:
+            self.__chunks[key] = self.__chunks.pop(key)
+        path = self.__chunk_path(track_id, index)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            if not self.__complete_chunk(index, len(data), self.length(track_id)):
+                log.warning("Deleting partial chunk {} from the audio cache".format(path))
+                os.unlink(path)
+                with self.__lock:
+                    self.__size -= self.__chunks.pop(key, 0)
+                return None
+            os.utime(path, None)  # Keep the LRU order across remounts
+        except (IOError, OSError):
+            log.exception("Error reading cached chunk {}".format(path))
+            with self.__lock:
+                self.__size -= self.__chunks.pop(key, 0)
+            return None
+        return data
+
+    def put(self, track_id, index, data):
+        """Store a chunk, evicting the least recently used ones if needed"""
+        key = (track_id, index)
+        if not data or len(data) > self.__max_size:
+            return
+        track_dir = os.path.join(self.__path, track_id)
+        path = self.__chunk_path(track_id, index)
+        try:
+            make_dirs(track_dir)
+            write_file(path, data)
+        except (IOError, OSError):
+            log.exception("Error writing cached chunk {}".format(path))
+            return
+        with self.__lock:
+            self.__size -= self.__chunks.pop(key, 0)
+            self.__chunks[key] = len(data)
+            self.__size += len(data)
+            self.__evict()
+
+    def complete(self, track_id):
+        """Tell if the whole audio of a track is in the cache"""
+        length = self.length(track_id)
+        if length is None:
+            return False
+        return all(self.has(track_id, index)
+                   for index in range((length + CHUNK_SIZE - 1) // CHUNK_SIZE))
+
+    def length(self, track_id):
+        """Return the audio length of a track, if it was ever fully known"""
+        try:
+            with open(os.path.join(self.__path, track_id, LENGTH_FILE)) as f:
+                return int(f.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def set_length(self, track_id, length):
+        track_dir = os.path.join(self.__path, track_id)
+        try:
+            make_dirs(track_dir)
+            write_file(os.path.join(track_dir, LENGTH_FILE), str(length))
+        except (IOError, OSError):
+            log.exception("Error writing length of {}".format(track_id))
+
+    def __evict(self):
+        """Drop the oldest chunks until the cache fits in its budget.
+        Must be called with the lock held."""
+        while self.__size > self.__max_size and self.__chunks:
+            (track_id, index), size = self.__chunks.popitem(last=False)
+            self.__size -= size
+            try:
+                os.unlink(self.__chunk_path(track_id, index))
+            except OSError:
+                pass
+
+
+class MemoryCache(object):
+    """Chunks of the tracks being played, shared by all tracks under a
+    global byte budget. The least recently used chunks are dropped first."""
+
+    def __init__(self, max_size):
+        self.__max_size = max_size
+        self.__lock = threading.Lock()
+        self.__chunks = OrderedDict()  # (track id, index) -> data, oldest first
+        self.__by_track = {}  # track id -> set of cached indexes
+        self.__size = 0
+        self.hits = self.misses = 0
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def max_size(self):
+        return self.__max_size
+
+    def has(self, track_id, index):
+        return (track_id, index) in self.__chunks
+
+    def get(self, track_id, index):
+        key = (track_id, index)
+        with self.__lock:
+            data = self.__chunks.pop(key, None)
+            if data is not None:
+                self.__chunks[key] = data  # Most recently used
+                self.hits += 1
+            else:
+                self.misses += 1
+            return data
+
+    def put(self, track_id, index, data):
+        key = (track_id, index)
+        with self.__lock:
+            old = self.__chunks.pop(key, None)
+            if old is not None:
+                self.__size -= len(old)
+            self.__chunks[key] = data
+            self.__by_track.setdefault(track_id, set()).add(index)
+            self.__size += len(data)
+            while self.__size > self.__max_size and len(self.__chunks) > 1:
+                (old_id, old_index), old = self.__chunks.popitem(last=False)
+                self.__forget(old_id, old_index)
+                self.__size -= len(old)
+
+    def discard(self, track_id):
+        """Free all the chunks of a track"""
+        with self.__lock:
+            for index in self.__by_track.pop(track_id, ()):
+                self.__size -= len(self.__chunks.pop((track_id, index)))
+
+    def __forget(self, track_id, index):
+        indexes = self.__by_track[track_id]
+        indexes.discard(index)
+        if not indexes:
+            del self.__by_track[track_id]
+
+
+class FileCache(object):
+    """Persistent store of small blobs (rendered tags, album art...) keyed by
+    name, capped to max_size bytes on disk with LRU eviction. The most
+    recently used blobs are also kept in memory, up to memory_size bytes."""
+
+    def __init__(self, path, max_size, memory_size=0):
+        self.__path = path
+        self.__max_size = max_size
+        self.__memory_size = memory_size
+        self.__lock = threading.Lock()
+        self.__files = OrderedDict()  # name -> size, oldest first
+        self.__size = 0
+        self.__memory = OrderedDict()  # name -> data, oldest first
+        self.__memory_used = 0
+        self.hits = self.misses = 0
+        if not os.path.isdir(self.__path):
+            os.makedirs(self.__path)
+        found = []
+        for name in os.listdir(self.__path):
+            if name.endswith('.tmp'):  # Left by an interrupted write
+                os.unlink(os.path.join(self.__path, name))
+                continue
+            st = os.stat(os.path.join(self.__path, name))
+            found.append((st.st_mtime, name, st.st_size))
+        found.sort()
+        for mtime, name, size in found:
+            self.__files[name] = size
+            self.__size += size
+        with self.__lock:
+            self.__evict()
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def max_size(self):
+        return self.__max_size
+
+    def has(self, name):
+        return name in self.__memory or name in self.__files
+
+    def get(self, name):
+        """Return a stored blob, or None"""
+        with self.__lock:
+            data = self.__memory.pop(name, None)
+            if data is not None:
+                self.__memory[name] = data
+            if name in self.__files:
+                self.__files[name] = self.__files.pop(name)
+            elif data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        path = os.path.join(self.__path, name)
+        try:
+            if data is None:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                self.__remember(name, data)
+            os.utime(path, None)
+        except (IOError, OSError):
+            if data is None:
+                log.exception("Error reading cached file {}".format(path))
+                with self.__lock:
+                    self.__size -= self.__files.pop(name, 0)
+        return data
+
+    def put(self, name, data):
+        path = os.path.join(self.__path, name)
+        try:
+            write_file(path, data)
+        except (IOError, OSError):
+            log.exception("Error writing cached file {}".format(path))
+        else:
+            with self.__lock:
+                self.__size -= self.__files.pop(name, 0)
+                self.__files[name] = len(data)
+                self.__size += len(data)
+                self.__evict()
+        self.__remember(name, data)
+
+    def __remember(self, name, data):
+        if len(data) > self.__memory_size:
+            return
+        with self.__lock:
+            old = self.__memory.pop(name, None)
+            if old is not None:
+                self.__memory_used -= len(old)
+            self.__memory[name] = data
+            self.__memory_used += len(data)
+            while self.__memory_used > self.__memory_size:
+                old_name, old = self.__memory.popitem(last=False)
+                self.__memory_used -= len(old)
+
+    def __evict(self):
+        """Must be called with the lock held"""
+        while self.__size > self.__max_size and self.__files:
+            name, size = self.__files.popitem(last=False)
+            self.__size -= size
+            try:
+                os.unlink(os.path.join(self.__path, name))
+            except OSError:
+                pass
+
+
+class ArtCache(object):
+    """Album art keyed by URL. Many albums share the same cover: each
+    distinct image is stored once, under the hash of its content."""
+
+    def __init__(self, path, max_size, memory_size):
+        self.__urls = FileCache(os.path.join(path, 'urls'), max_size // 1024)
+        self.__images = FileCache(os.path.join(path, 'images'), max_size, memory_size)
+        self.hits = self.misses = 0
+
+    def get(self, url):
+        digest = self.__urls.get(self.__url_key(url))
+        data = None if digest is None else self.__images.get(digest)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def has(self, url):
+        """Tell if the art of url is stored, without reading it"""
+        return self.__urls.has(self.__url_key(url))
+
+    def put(self, url, data):
+        digest = hashlib.sha1(data).hexdigest()
+        if not self.__images.has(digest):
+            self.__images.put(digest, data)
+        self.__urls.put(self.__url_key(url), digest)
+
+    def __url_key(self, url):
+        return hashlib.sha1(url).hexdigest()
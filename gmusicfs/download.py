@@ -0,0 +1,108 @@
+"""
+Scheduler of the audio and art downloads of gmusicfs.
+
+Every download runs on one bounded pool of worker threads, instead of in
+the thread that needs it: a FUSE read, a read-ahead or a prefetch submits
+its download and waits for the returned Call. Pending downloads are served
+by priority, so the reads a player is blocked on go before read-ahead, and
+read-ahead before prefetching.
+"""
+
+import heapq
+import logging
+import threading
+import itertools
+
+from .prefetch import Call
+
+log = logging.getLogger('gmusicfs.download')
+
+PRIORITY_READ = 0  # A reader is waiting for the data
+PRIORITY_READAHEAD = 1
+PRIORITY_PREFETCH = 2
+
+
+class Downloader(object):
+    """Runs download functions on a pool of workers, by priority"""
+
+    def __init__(self, workers):
+        self.__workers = workers
+        self.__threads = []  # Started on first use, so they survive daemonizing
+        self.__queue = []  # Heap of (priority, sequence, function, call)
+        self.__sequence = itertools.count()  # First come, first served
+        self.__lock = threading.Lock()
+        self.__submitted = threading.Condition(self.__lock)
+        self.__running = 0
+        self.__closed = False
+        self.__local = threading.local()
+
+    @property
+    def queued(self):
+        """Downloads waiting for a worker"""
+        return len(self.__queue)
+
+    @property
+    def running(self):
+        return self.__running
+
+    def submit(self, function, priority=PRIORITY_READ):
+        """Schedule function(), returns its Call"""
+        call = Call()
+        with self.__lock:
+            if self.__closed:
+                raise RuntimeError('Downloader closed')
+            if not self.__threads:
+                for i in range(self.__workers):
+                    thread = threading.Thread(target=self.__work, name='download')
+                    thread.daemon = True
+                    thread.start()
+                    self.__threads.append(thread)
+            heapq.heappush(self.__queue, (priority, next(self.__sequence), function, call))
+            self.__submitted.notify()
+        return call
+
+    def run(self, function, priority=PRIORITY_READ):
+        """Run function() on a worker and return its result. On a worker,
+        it is run right away: waiting for another one could deadlock."""
+        if getattr(self.__local, 'worker', False):
+            return function()
+        return self.submit(function, priority).get()
+
+    def cancel(self, call):
+        """Drop a download that did not start yet"""
+        with self.__lock:
+            for i, job in enumerate(self.__queue):
+                if job[3] is call:
+                    self.__queue[i] = self.__queue[-1]
+                    self.__queue.pop()
+                    heapq.heapify(self.__queue)
+                    break
+            else:
+                return
+        call.set(error=RuntimeError('Download cancelled'))
+
+    def __work(self):
+        self.__local.worker = True
+        while True:
+            with self.__lock:
+                while not self.__queue and not self.__closed:
+                    self.__submitted.wait()
+                if self.__closed:
+                    return
+                priority, sequence, function, call = heapq.heappop(self.__queue)
+                self.__running += 1
+            try:
+                call.set(function())
+            except Exception as e:
+                call.set(error=e)  # Raised again in the waiting thread
+            finally:
+                with self.__lock:
+                    self.__running -= 1
+
+    def close(self):
+        with self.__lock:
+            self.__closed = True
+            queue, self.__queue = self.__queue, []
+            self.__submitted.notify_all()
+        for priority, sequence, function, call in queue:
+            call.set(error=RuntimeError('Downloader closed'))
@@ -3,14 +3,21 @@
 import os
 import re
 import sys
-import urllib2
 import ConfigParser
-from errno import ENOENT
+from errno import ENOENT, ENOTDIR, EROFS
 from stat import S_IFDIR, S_IFREG
 import argparse
-import tempfile
+import bisect
+import hashlib
+import functools
+import heapq
 import logging
 import pprint
+import threading
+import itertools
+import time
+import datetime
+from collections import OrderedDict
 
 from eyed3.id3 import Tag, ID3_V2_4
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn#, fuse_get_context
@@ -18,6 +25,15 @@ from fuse import FUSE, FuseOSError, Operations, LoggingMixIn#, fuse_get_context
 from gmusicapi import Mobileclient as GoogleMusicAPI
 #from gmusicapi import Webclient as GoogleMusicWebAPI
 
+from .cache import CHUNK_SIZE, AudioCache, MemoryCache, FileCache, ArtCache
+from .download import Downloader, PRIORITY_PREFETCH
+from .metadata import MetadataCache
+from .prefetch import Prefetcher
+from .search import SearchIndex, SearchResults
+from .stats import Stats, StatsFile
+from .stream import RangeStream, Sessions, StreamURLs
+from .transport import Transport, DEFAULT_TIMEOUT, DEFAULT_MAX_CONNECTIONS
+
 reload(sys)  # Reload does the trick
 sys.setdefaultencoding('UTF-8')
 
@@ -25,29 +41,93 @@ logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger('gmusicfs')
 pp = pprint.PrettyPrinter(indent=4)  # For debug logging
 
-ALBUM_REGEX = '(?P<album>[^/]+) \((?P<year>[0-9]{4})\)'
 ALBUM_FORMAT = u'{name} ({year:04d})'
 
-TRACK_REGEX = '(?P<track>(?P<number>[0-9]+) - (?P<title>.*)\.mp3)'
 TRACK_FORMAT = '{number:02d} - {name}.mp3'
+TRACK_NAME_REGEX = re.compile(r'\d{2,} - .+\.mp3$')  # Names of the files of tracks
 
 ID3V1_TRAILER_SIZE = 128
 
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gmusicfs')
+DEFAULT_CACHE_SIZE = 1024  # MiB
+DEFAULT_MEMORY_SIZE = 64  # MiB
+DEFAULT_TAG_CACHE_SIZE = 512  # MiB of rendered tags kept on disk
+
+ALBUM_INFO_WORKERS = 8  # Concurrent get_album_info calls
+ALBUM_INFO_RETRY_DELAY = 600  # Seconds before fetching album info that failed again
+
+TAG_MEMORY_SIZE = 16 * 1024**2  # Rendered tags kept in memory
+TAG_SAMPLE = 50  # Tags rendered before estimating the size of all of them
+
+SIZE_WORKERS = 4  # Concurrent exact size computations
+
+UPCOMING_TRACKS = 2  # Tracks after the one opened to prepare for playback
+UPCOMING_SECONDS = 10  # Audio of each of them to download ahead
+UPCOMING_BITRATE = 320000  # Bits per second of the Google Music streams
+UPCOMING_WORKERS = 1  # Low priority: one track at a time
+
+ART_WORKERS = 4  # Concurrent album art downloads
+ART_CACHE_SIZE = 512 * 1024**2
+ART_MEMORY_SIZE = 16 * 1024**2
+ART_RETRY_DELAY = 600  # Seconds before downloading art that failed again
+COVER_NAMES = ('cover.jpg', 'folder.jpg')
+
+SEARCH_DIR = '/search'
+BROWSE_DIRS = ('/artists', '/albums', '/genres', '/years', '/recent', '/playlists')
+RECENT_TRACKS = 200  # Most recently added tracks listed in /recent
+
+CONTROL_DIR = '/.gmusicfs'
+STATS_PATH = CONTROL_DIR + '/stats'
+RESCAN_PATH = CONTROL_DIR + '/rescan'
+
+POPULATE_BATCH = 1000  # Tracks added to the filesystem at a time
+LOOKUP_TIMEOUT = 30  # Seconds a lookup waits for the library to be loaded
+
+KERNEL_CACHE_TIMEOUT = 300  # Seconds the kernel keeps attributes and entries, at most
+
 def formatNames(string_from):
     """Format a name to make it suitable to use as a filename"""
     return re.sub('/', '-', string_from)
 
+_shared_strings = {}
+
+def shared(string):
+    """Return a single copy of equal strings (artists, albums, genres...)"""
+    return _shared_strings.setdefault(string, string)
+
+def inode(kind, key):
+    """Inode number of an artist, album, track... the same on every mount"""
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(hashlib.sha1('{}:{}'.format(kind, key)).hexdigest()[:15], 16)
+
+def render_tag(tag):
+    """Render an ID3 v2.4 tag in memory, padding included"""
+    try:
+        rendered = tag._render(ID3_V2_4, 0, None)
+    except TypeError: # eyeD3 < 0.8 has no max_padding argument
+        rendered = tag._render(ID3_V2_4, 0)
+    data = rendered[1]
+    padding = rendered[2] if len(rendered) > 2 else 0
+    if isinstance(padding, (int, long)):
+        padding = b'\x00' * padding
+    return data + padding
+
 
 class NoCredentialException(Exception):
     pass
+
+class LoginException(Exception):
+    pass
         
         
 class Artist(object):
+    __slots__ = ('__library', '__id', '__name', '__albums')
     
     def __init__(self, library, data):
         self.__library = library
         self.__id = data['artistId'][0]
-        self.__name = data['artist']
+        self.__name = shared(data['artist'])
         self.__albums = {}
         
     @property
@@ -62,27 +142,43 @@ class Artist(object):
     def albums(self):
         return self.__albums
     
+    @property
+    def inode(self):
+        return inode('artist', self.__id)
+    
+    @property
+    def mtime(self):
+        """When its latest track was modified"""
+        return max([album.mtime for album in self.__albums.values()] or [0])
+    
     def add_album(self, album):
         self.__albums[album.title] = album
     
+    def __unicode__(self):
+        return u"{0.name}".format(self)
+
     def __str__(self):
-        return "{0.name}".format(self)
+        return unicode(self).encode('utf-8')
     
 class Album(object):
+    __slots__ = ('__library', '__id', '__artist', '__title', '__tracks', '__year',
+                 '__art_url', '__loaded', '__lock')
     
-    def __init__(self, library, data):
+    def __init__(self, library, data, artist=None):
         self.__library = library
         self.__id = data['albumId']
-        self.__artist = self.__library.artists.get(data['artistId'][0], None)
-        self.__title = data['album']
+        if artist is None:
+            artist = self.__library.artists.get(data['artistId'][0], None)
+        self.__artist = artist
+        self.__title = shared(data['album'])
         self.__tracks = {}
         self.__year = 0
         if 'albumArtRef' in data:
             self.__art_url = data['albumArtRef'][0]['url']
         else:
             self.__art_url = None
-        self.__art = None
-        self.__album_info = None
+        self.__loaded = False
+        self.__lock = threading.Lock()
         
     @property
     def id(self):
@@ -90,15 +186,50 @@ class Album(object):
         
     @property
     def tracks(self):
-        if not self.__album_info: # Load all the tracks only on request
-            try:
-                self.__album_info = self.__library.api.get_album_info(self.__id)
-                for track in self.__album_info['tracks']:
-                    self.add_track(Track(self.__library, track))
-            except:
-                log.exception("Error loading album info")
+        # Load all the tracks only on request, and not again and again when
+        # Google Music has no info on the album, as for uploaded tracks:
+        if not self.__loaded and not self.__library.album_info_failed(self.__id):
+            with self.__lock:
+                if not self.__loaded and not self.__library.album_info_failed(self.__id):
+                    try:
+                        album_info = self.__library.get_album_info(self.__id)
+                        mtime = self.mtime
+                        for data in album_info['tracks']:
+                            # The tracks of the library have other ids, keep
+                            # them so a track is downloaded and cached once:
+                            track = self.__library.library_track(data)
+                            if track is None:
+                                # It has no timestamps, keep the album ones:
+                                data = dict(data, lastModifiedTimestamp=mtime * 1000000)
+                                track = Track(self.__library, data, self)
+                                if track.title in self.__tracks:
+                                    continue
+                                self.__library.tracks.setdefault(track.id, track)
+                            self.add_track(track)
+                        self.__loaded = True
+                    except:
+                        log.exception("Error loading album info")
+        return self.__tracks
+
+    @property
+    def tracks_loaded(self):
+        """True once the album info was fetched from Google Music"""
+        return self.__loaded
+
+    @property
+    def loaded_tracks(self):
+        """The tracks known so far, without fetching the album info"""
         return self.__tracks
 
+    @property
+    def inode(self):
+        return inode('album', self.__id)
+
+    @property
+    def mtime(self):
+        """When its latest track was modified"""
+        return max([track.mtime for track in self.__tracks.values()] or [0])
+
     @property
     def title(self):
         return self.__title
@@ -113,39 +244,53 @@ class Album(object):
     def artist(self):
         return self.__artist
     
+    @property
+    def art_url(self):
+        return self.__art_url
+    
     @property
     def art(self):
-        if not self.__art:
-            self.__load_art()
-        return self.__art
+        if not self.__art_url:
+            return None
+        return self.__library.get_art(self.__art_url)
+
+    @property
+    def has_art(self):
+        """True once the art was downloaded"""
+        return bool(self.__art_url) and self.__library.has_art(self.__art_url)
      
     def add_track(self, track):
         self.__tracks[track.title] = track
-        if track.id not in self.__library.tracks:
-            self.__library.tracks[track.id] = track
+
+    def entries(self):
+        """The files of its directories by name: the tracks known so far,
+        and the cover once downloaded"""
+        entries = dict((formatNames(unicode(track)), track) for track in self.__tracks.values())
+        if self.has_art:
+            cover = Cover(self)
+            for name in COVER_NAMES:
+                entries[name] = cover
+        return entries
 
     def __get_year(self):
         # some tracks are not loaded from album_info, let's use them to get the album date release
         for track in self.__tracks.values():
             self.__year = track.year or self.__year
 
-    def __load_art(self):
-        if not self.__art_url:
-            return
-        log.info("loading art album: {0.title}".format(self))
-        self.__art = ""
-        u = urllib2.urlopen(self.__art_url)
-        data = u.read()
-        while data != "":
-            self.__art += data
-            data = u.read()
+    def __unicode__(self):
+        return u"{0.title} ({0.year:04d})".format(self)
 
     def __str__(self):
-        return "{0.title} ({0.year:04d})".format(self)
+        return unicode(self).encode('utf-8')
 
 class Track(object):
+    # Tracks are numerous: only keep what the tag and the attributes need
+    __slots__ = ('__library', '__id', '__title', '__number', '__year', '__album',
+                 '__artist', '__album_title', '__album_artist', '__genre', '__disc',
+                 '__size', '__ctime', '__mtime', '__atime',
+                 '__session', '__handles', '__rendered_tag', '__lock')
     
-    def __init__(self, library, data):
+    def __init__(self, library, data, album=None):
         self.__library = library
         if 'track' in data: # Playlists manage tracks in a different way
             self.__id = data['trackId']
@@ -157,49 +302,75 @@ class Track(object):
         else:
             self.__id = data['nid']
             
-        self.__data = data
         self.__title = data['title']
         self.__number = int(data['trackNumber'])
         self.__year = int(data.get('year', 0))
-        self.__album = self.__library.albums.get(data['albumId'], None)
-        self.__url = None
-        self.__stream_cache = ""
+        if album is None:
+            album = self.__library.albums.get(data['albumId'], None)
+        self.__album = album
+        self.__artist = shared(data['artist'])
+        self.__album_title = shared(data['album'])
+        if data.get('albumArtist', self.__artist) != self.__artist:
+            self.__album_artist = shared(data['albumArtist'])
+        else:
+            self.__album_artist = None
+        self.__genre = shared(data['genre']) if 'genre' in data else None
+        self.__disc = int(data['discNumber']) if 'discNumber' in data else None
+        
+        if 'bytes' in data:
+            self.__size = int(data['bytes'])
+        elif 'estimatedSize' in data:
+            self.__size = int(data['estimatedSize'])
+        else:
+            self.__size = int(data['tagSize'])
+        self.__ctime = int(data.get('creationTimestamp', 0)) / 1000000
+        # Changes with the metadata, so the kernel drops its cached pages:
+        self.__mtime = int(data.get('lastModifiedTimestamp', 0)) / 1000000 or self.__ctime
+        self.__atime = int(data.get('recentTimestamp', 0)) / 1000000
+        
+        self.__session = None  # Shared with the other handles of the track
+        self.__handles = 0
         self.__rendered_tag = None
-        self.__tag = None
+        self.__lock = threading.Lock()  # Guards the handles state
         
+    def tag_key(self):
+        """Name of the rendered tag in the tag cache, changes with its content"""
+        fields = (self.__album_title, self.__artist, self.__title, self.__number,
+                  self.__disc, self.__genre, self.__album_artist, self.__year,
+                  self.album and self.album.art_url)
+        return '{}-{}'.format(self.__id, hashlib.sha1(repr(fields)).hexdigest()[:16])
+    
+    def render_tag(self):
+        """Return the rendered ID3 tag, from the tag cache when possible"""
+        key = self.tag_key()
+        rendered = self.__library.tags.get(key)
+        if rendered is None:
+            rendered, complete = self.__gen_tag()
+            if complete:  # Otherwise the art is missing, try again next time
+                self.__library.tags.put(key, rendered)
+        return rendered
+    
     def __gen_tag(self):
         log.info("Creating tag idv3...")
-        self.__tag = Tag()
-        self.__tag.album = self.__data['album']
-        self.__tag.artist = self.__data['artist']
-        
-        if self.__data.has_key('album'):
-            self.__tag.album = self.__data['album']
-        if self.__data.has_key('artist'):
-            self.__tag.artist = self.__data['artist']
-        if self.__data.has_key('title'):
-            self.__tag.title = self.__data['title']
-        if self.__data.has_key('discNumber'):
-            self.__tag.disc_num = int(self.__data['discNumber'])
-        if self.__data.has_key('trackNumber'):
-            self.__tag.track_num = int(self.__data['trackNumber'])
-        if self.__data.has_key('genre'):
-            self.__tag.genre = self.__data['genre']
-        if self.__data.has_key('albumArtist') and self.__data['albumArtist'] != self.__data['artist']:
-            self.__tag.album_artist = self.__data['albumArtist']
-        if self.__data.has_key('year') and int(self.__data['year']) != 0:
-            self.__tag.recording_date = self.__data['year']
+        tag = Tag()
+        tag.album = self.__album_title
+        tag.artist = self.__artist
+        tag.title = self.__title
+        tag.track_num = self.__number
+        if self.__disc is not None:
+            tag.disc_num = self.__disc
+        if self.__genre is not None:
+            tag.genre = self.__genre
+        if self.__album_artist is not None:
+            tag.album_artist = self.__album_artist
+        if self.__year:
+            tag.recording_date = self.__year
             
-        if self.album and self.album.art:
-            self.__tag.images.set(0x03, self.album.art, 'image/jpeg', u'Front cover')
+        art = self.album and self.album.art
+        if art:
+            tag.images.set(0x03, art, 'image/jpeg', u'Front cover')
         
-        tmpfd, tmpfile = tempfile.mkstemp()
-        os.close(tmpfd)
-        self.__tag.save(tmpfile, ID3_V2_4)
-        tmpfd = open(tmpfile, "r")
-        self.__rendered_tag = tmpfd.read()
-        tmpfd.close()
-        os.unlink(tmpfile)
+        return render_tag(tag), bool(art or not (self.album and self.album.art_url))
         
     @property
     def id(self):
@@ -221,74 +392,160 @@ class Track(object):
     def year(self):
         return self.__year
     
+    @property
+    def artist(self):
+        return self.__artist
+    
+    @property
+    def album_title(self):
+        return self.__album_title
+    
+    @property
+    def genre(self):
+        return self.__genre
+    
+    @property
+    def ctime(self):
+        return self.__ctime
+    
+    @property
+    def mtime(self):
+        return self.__mtime
+    
+    @property
+    def inode(self):
+        return inode('track', self.__id)
+    
     def get_attr(self):
         st = {}
         st['st_mode'] = (S_IFREG | 0o444)
         st['st_nlink'] = 1
-        st['st_ctime'] = st['st_mtime'] = st['st_atime'] = 0
-        
-        if 'bytes' in self.__data:
-            st['st_size'] = int(self.__data['bytes'])
-        elif 'estimatedSize' in self.__data:
-            st['st_size'] = int(self.__data['estimatedSize'])
-        else:
-            st['st_size'] = int(self.__data['tagSize'])
-        
-        if 'creationTimestamp' in self.__data:
-            st['st_ctime'] = st['st_mtime'] = int(self.__data['creationTimestamp']) / 1000000
-        if 'recentTimestamp' in self.__data:
-            st['st_atime'] = int(self.__data['recentTimestamp']) / 1000000
+        st['st_size'] = self.__library.exact_size(self) or self.__size
+        st['st_ctime'] = st['st_mtime'] = self.__mtime
+        st['st_atime'] = self.__atime
         return st
         
-    def _open(self):
-        pass
-        #self.__url = urllib2.urlopen(self.__library.get_stream_url(self.id))
-        #self.__stream_cache += self.__url.read(8192) # Some caching
-            
     def read(self, offset, size):
-        if not self.__tag: # Crating tag only when needed
-            self.__gen_tag()
-            self.__stream_cache = str(self.__rendered_tag or "")
-        
-        if offset == 0 and not self.__url:
-            self.__url = urllib2.urlopen(self.__library.get_stream_url(self.id))
-        
-        if not self.__url:
-            return ''
+        with self.__lock:
+            if self.__rendered_tag is None: # Crating tag only when needed
+                self.__rendered_tag = self.render_tag()
+            tag = self.__rendered_tag or ""
+            session = self.__session
         
-        self.__stream_cache += self.__url.read(offset + size - len(self.__stream_cache))
-        return self.__stream_cache[offset:offset + size]
+        # The file is the rendered tag followed by the audio stream:
+        data = tag[offset:offset + size]
+        if len(data) < size:
+            data += session.read(max(offset - len(tag), 0), size - len(data))
+        return data
+    
+    def open(self):
+        session = self.__library.sessions.acquire(self.id)
+        with self.__lock:
+            self.__handles += 1
+            self.__session = session
+        if not self.__library.cache.complete(self.id):
+            # Playback is likely to start soon:
+            self.__library.stream_urls.prefetch(self.id)
     
     def close(self):
-        pass
-        #if self.__url:
-        #    log.info("killing url")
-        #    self.__stream_cache = str(self.__rendered_tag or "")
-        #    self.__url.close()
-        #    self.__url = None
+        """Release a handle, freeing the stream buffers with the last one"""
+        with self.__lock:
+            self.__handles -= 1
+            if self.__handles <= 0:
+                self.__handles = 0
+                self.__rendered_tag = None
+                self.__session = None
+        self.__library.sessions.release(self.id)
     
+    def __unicode__(self):
+        return u"{0.number:02d} - {0.title}.mp3".format(self)
+
     def __str__(self):
-        return "{0.number:02d} - {0.title}.mp3".format(self)
+        return unicode(self).encode('utf-8')
+
+class Cover(object):
+    """The art of an album, as an image file in the album directory"""
+    __slots__ = ('__album',)
+    
+    def __init__(self, album):
+        self.__album = album
+    
+    @property
+    def album(self):
+        return self.__album
+    
+    @property
+    def inode(self):
+        return inode('cover', self.__album.id)
+    
+    def get_attr(self):
+        st = {}
+        st['st_mode'] = (S_IFREG | 0o444)
+        st['st_nlink'] = 1
+        st['st_size'] = len(self.__album.art or "")
+        st['st_ctime'] = st['st_mtime'] = st['st_atime'] = self.__album.mtime
+        return st
+    
+    def read(self, offset, size):
+        return (self.__album.art or "")[offset:offset + size]
+    
+    def open(self):
+        pass
+    
+    def close(self):
+        pass
+
+class RescanFile(object):
+    """Opening it for writing requests a rescan of the library, reading it
+    tells when the last one happened and what it changed"""
+    __slots__ = ('__library',)
+    
+    def __init__(self, library):
+        self.__library = library
+    
+    def __status(self):
+        return self.__library.rescan_status + '\n'
+    
+    def get_attr(self):
+        st = {}
+        st['st_mode'] = (S_IFREG | 0o644)
+        st['st_nlink'] = 1
+        st['st_size'] = len(self.__status())
+        st['st_ctime'] = st['st_mtime'] = st['st_atime'] = 0
+        return st
+    
+    def read(self, offset, size):
+        return self.__status()[offset:offset + size]
+    
+    def open(self):
+        pass
+    
+    def close(self):
+        pass
 
 class Playlist(object):
     """This class manages playlist information"""
+    __slots__ = ('__library', '__id', '__name', '__mtime', '__tracks')
 
-    def __init__(self, library, data):
+    def __init__(self, library, data, index):
         self.__library = library
         self.__id = data['id']
         self.__name = data['name']
+        self.__mtime = int(data.get('lastModifiedTimestamp', 0)) / 1000000
         self.__tracks = {}
         for track in data['tracks']:
             trackId = track['trackId']
             try:
                 if 'track' in track:
                     albumId = track['track']['albumId']
-                    if albumId not in self.__library.albums:
-                        self.__library.albums[albumId] = Album(self.__library, track['track'])
-                if trackId in self.__library.tracks:
-                    tr = self.__library.tracks[trackId]
+                    if albumId not in index.albums:
+                        artist = index.artists.get(track['track']['artistId'][0], None)
+                        index.albums[albumId] = Album(self.__library, track['track'], artist)
+                if trackId in index.tracks:
+                    tr = index.tracks[trackId]
                 else:
-                    tr = Track(self.__library, track)
+                    album = index.albums.get(track['track']['albumId']) if 'track' in track else None
+                    tr = Track(self.__library, track, album)
                 self.__tracks[tr.title] = tr
             except:
                 log.exception("error: {}".format(track))
@@ -307,20 +564,151 @@ class Playlist(object):
     def tracks(self):
         return self.__tracks
 
+    @property
+    def inode(self):
+        return inode('playlist', self.__id)
+
+    @property
+    def mtime(self):
+        return self.__mtime or max([track.mtime for track in self.__tracks.values()] or [0])
+
+    def __unicode__(self):
+        return u"{0.name}".format(self)
+
     def __str__(self):
-        return "{0.name}".format(self)
+        return unicode(self).encode('utf-8')
+
+class PathIndex(object):
+    """Maps every path of the filesystem to the object it names. An album
+    is listed in several directories: their files are not stored, but
+    looked up in the album."""
+
+    def __init__(self):
+        self.__nodes = {}  # path -> Artist, Album, Playlist, Track or None
+        self.__entries = {}  # directory path -> {name: node}
+        self.__listings = {}  # directory path -> sorted names, until it changes
+        self.add_dir('/')
+
+    def __add(self, path, node):
+        parent, name = path.rsplit('/', 1)
+        parent = parent or '/'
+        self.__entries[parent][name] = node
+        self.__listings.pop(parent, None)
+        self.__nodes[path] = node
+
+    def add_dir(self, path, node=None):
+        if path != '/':
+            self.__add(path, node)
+        else:
+            self.__nodes[path] = node
+        if not isinstance(node, Album):
+            self.__entries.setdefault(path, {})
+        return path
+
+    def add_file(self, path, node):
+        self.__add(path, node)
+        return path
+
+    def join(self, path, name):
+        """Path of an entry of a directory, as unicode like the paths FUSE
+        looks up"""
+        return (path if path != '/' else u'') + u'/' + formatNames(unicode(name))
+
+    def lookup(self, path):
+        """Return the object named by path, or raise KeyError"""
+        try:
+            return self.__nodes[path]
+        except KeyError:
+            parent, _, name = path.rpartition('/')
+            album = self.__nodes.get(parent)
+            if not isinstance(album, Album):
+                raise
+            return album.entries()[name]
+
+    def is_dir(self, path):
+        return path in self.__entries or isinstance(self.__nodes.get(path), Album)
+
+    def listdir(self, path):
+        """Sorted names of the entries of a directory"""
+        album = self.__nodes.get(path)
+        if isinstance(album, Album):
+            return sorted(album.entries())
+        listing = self.__listings.get(path)
+        if listing is None:
+            listing = self.__listings[path] = sorted(self.__entries[path])
+        return listing
+
+    def __contains__(self, path):
+        try:
+            self.lookup(path)
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.__nodes)
+
+class LibraryIndex(object):
+    """The artists, albums, tracks, playlists and paths of a library. A
+    rescan builds a new one and swaps it with the live one at once."""
+
+    def __init__(self):
+        self.artists = {}
+        self.artists_by_name = {}
+        self.albums = {}
+        self.tracks = {}
+        self.store_ids = {}  # Store id or nid -> id of the track in the library
+        self.playlists = {}
+        self.paths = None
+        self.search = SearchIndex()
+        self.errors = 0
+        self.mtime = 0  # When the latest track was modified
 
 class MusicLibrary(object):
     """This class reads information about your Google Play Music library"""
     def __init__(self, username=None, password=None,
-                 true_file_size=False, verbose=0):
+                 true_file_size=False, verbose=0,
+                 cache_dir=DEFAULT_CACHE_DIR, cache_size=DEFAULT_CACHE_SIZE,
+                 memory_size=DEFAULT_MEMORY_SIZE, timeout=DEFAULT_TIMEOUT,
+                 max_connections=DEFAULT_MAX_CONNECTIONS,
+                 tag_cache_size=DEFAULT_TAG_CACHE_SIZE):
         
         self.verbose = bool(verbose)
+        self.true_file_size = true_file_size
+        self.__lock = threading.RLock()  # Held while the library is (re)built
+        self.stats = Stats()
+        self.__stats_file = StatsFile(self.stats)
+        self.__rescan_file = RescanFile(self)
+        self.__rescan_requested = threading.Event()
+        self.__rescan_status = 'Not rescanned since mounted'
+        self.cache = AudioCache(os.path.join(cache_dir, 'audio'), cache_size * 1024**2)
+        self.memory = MemoryCache(memory_size * 1024**2)
+        self.metadata = MetadataCache(os.path.join(cache_dir, 'metadata.db'))
+        self.tags = FileCache(os.path.join(cache_dir, 'tags'), tag_cache_size * 1024**2,
+                              TAG_MEMORY_SIZE)
+        self.art = ArtCache(os.path.join(cache_dir, 'art'), ART_CACHE_SIZE, ART_MEMORY_SIZE)
+        self.transport = Transport(timeout, max_connections)
+        self.downloader = Downloader(max_connections)
+        self.__arts = Prefetcher(self.__fetch_art, ART_WORKERS)
+        self.__art_failures = {}  # url -> when its download last failed
+        self.__album_infos = Prefetcher(self.__fetch_album_info, ALBUM_INFO_WORKERS)
+        self.__album_info_failures = {}  # album id -> when its album info last failed
+        self.__sizes = Prefetcher(self.__compute_size, SIZE_WORKERS)
+        self.__upcoming = Prefetcher(self.__warm_upcoming, UPCOMING_WORKERS)
+        self.__upcoming_tracks = []  # Tracks of the last prefetch_upcoming call
+        self.__generation = 0  # Bumped to cancel the upcoming prefetches
+        self.__exact_sizes = self.metadata.load_sizes()  # track id -> (tag key, size)
         self.api = GoogleMusicAPI(debug_logging=self.verbose)
-        self.__login_and_setup(username, password)
-        self.rescan()
+        self.stream_urls = StreamURLs(self.__get_stream_url)
+        self.sessions = Sessions(self.__new_stream)
+        self.__register_stats()
+        self.__credentials = self.__read_credentials(username, password)
+        self.__logged_in = False
+        self.__populated = False
+        self.__arrived = threading.Condition()  # Notified as tracks are added
+        self.__new_index(live=True)
     
-    def __login_and_setup(self, username=None, password=None):
+    def __read_credentials(self, username=None, password=None):
         # If credentials are not specified, get them from $HOME/.gmusicfs
         if not username or not password:
             cred_path = os.path.join(os.path.expanduser('~'), '.gmusicfs')
@@ -342,249 +730,797 @@ class MusicLibrary(object):
                 raise NoCredentialException(
                     'No username/password could be read from config file'
                     ': %s' % cred_path)
+        return username, password
 
+    def login(self):
+        """Log in to Google Music, once. Raises LoginException on failure."""
+        if self.__logged_in:
+            return
+        username, password = self.__credentials
         log.info('Logging in...')
-        self.api.login(username, password, GoogleMusicAPI.FROM_MAC_ADDRESS)
+        if not self.api.login(username, password, GoogleMusicAPI.FROM_MAC_ADDRESS):
+            raise LoginException('Could not log in to Google Music as {}'.format(username))
+        self.__logged_in = True
         log.info('Login successful.')
 
+    def __register_stats(self):
+        stats = self.stats
+        stats.describe('gmusicfs_api_calls_total', 'counter', 'Google Music API calls')
+        stats.describe('gmusicfs_bytes_served_total', 'counter', 'Bytes read from the filesystem')
+        stats.register('gmusicfs_bytes_fetched_total', 'counter', 'Bytes downloaded',
+                       lambda: self.transport.bytes_received)
+        stats.register('gmusicfs_downloads_queued', 'gauge', 'Downloads waiting for a worker',
+                       lambda: self.downloader.queued)
+        stats.register('gmusicfs_downloads_running', 'gauge', 'Downloads in progress',
+                       lambda: self.downloader.running)
+        stats.register('gmusicfs_http_requests_total', 'counter', 'Audio and art HTTP requests',
+                       lambda: self.transport.requests)
+        stats.register('gmusicfs_http_connections_total', 'counter', 'HTTP connections opened',
+                       lambda: self.transport.connections)
+        stats.register('gmusicfs_http_connect_seconds_total', 'counter',
+                       'Time spent opening HTTP connections',
+                       lambda: repr(self.transport.connect_time))
+        for name, cache in (('audio', self.cache), ('memory', self.memory),
+                            ('tags', self.tags), ('art', self.art)):
+            stats.register('gmusicfs_{}_cache_hits_total'.format(name), 'counter',
+                           'Lookups found in the {} cache'.format(name),
+                           lambda cache=cache: cache.hits)
+            stats.register('gmusicfs_{}_cache_misses_total'.format(name), 'counter',
+                           'Lookups missing from the {} cache'.format(name),
+                           lambda cache=cache: cache.misses)
+        stats.register('gmusicfs_audio_cache_bytes', 'gauge', 'Size of the audio cache',
+                       lambda: self.cache.size)
+        stats.register('gmusicfs_memory_cache_bytes', 'gauge', 'Size of the memory cache',
+                       lambda: self.memory.size)
+        stats.describe('gmusicfs_upcoming_prefetches_total', 'counter',
+                       'Upcoming tracks prepared for playback, or cancelled')
+        stats.register('gmusicfs_stream_sessions', 'gauge', 'Tracks being read',
+                       lambda: len(self.sessions))
+        stats.register('gmusicfs_tracks', 'gauge', 'Tracks in the library',
+                       lambda: len(self.tracks))
+    
     @property
     def artists(self):
-        return self.__artists
+        return self.__index.artists
     
     @property
     def artists_by_name(self):
-        return self.__artists_by_name
+        return self.__index.artists_by_name
     
     @property
     def albums(self):
-        return self.__albums
+        return self.__index.albums
     
     @property
     def playlists(self):
-        return self.__playlists
+        return self.__index.playlists
+    
+    @property
+    def paths(self):
+        return self.__index.paths
         
     @property
     def tracks(self):
-        return self.__tracks
+        return self.__index.tracks
+
+    def library_track(self, data):
+        """The track of the library an album info track is, if any"""
+        index = self.__index
+        for key in ('storeId', 'nid'):
+            track = index.tracks.get(index.store_ids.get(data.get(key)))
+            if track is not None:
+                return track
+        return None
+    
+    @property
+    def mtime(self):
+        return self.__index.mtime
+    
+    @property
+    def rescan_status(self):
+        return self.__rescan_status
+    
+    @property
+    def has_snapshot(self):
+        """True if the library was scanned before, and can be loaded offline"""
+        return self.metadata.get('synced') is not None
+    
+    @property
+    def populated(self):
+        """True once the library was loaded, or failed to"""
+        return self.__populated
+    
+    def wait(self, path=None, timeout=None):
+        """Wait until path is in the filesystem, or until the whole library
+        is loaded when path is None. Returns True if it happened in time."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.__arrived:
+            while not self.__populated and (path is None or path not in self.paths):
+                if deadline is None:
+                    self.__arrived.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.__arrived.wait(remaining)
+        return self.__populated if path is None else path in self.paths
+    
+    def populate(self):
+        """Load the library, from the local snapshot if there is one, which
+        needs no network. Tracks show up in the filesystem as they are
+        loaded, so it can be used in the meantime."""
+        try:
+            self.load()
+        finally:
+            with self.__arrived:
+                self.__populated = True
+                self.__arrived.notify_all()
+    
+    def load(self):
+        """Load the library from the local snapshot, scan it if there is none"""
+        if self.metadata.get('synced') is None:
+            return self.rescan()
+        with self.__lock:
+            log.info('Loading library snapshot...')
+            index = self.__new_index(live=True)
+            tracks = self.metadata.load_tracks()
+            for start in range(0, len(tracks), POPULATE_BATCH):
+                self.__add_tracks(index, tracks[start:start + POPULATE_BATCH], live=True)
+            self.__finish_index(index, self.metadata.load_playlists())
     
     def rescan(self):
-        """Scan the Google Play Music library"""
-        self.__artists = {}
-        self.__artists_by_name = {}
-        self.__albums = {}
-        self.__tracks = {}
-        self.__playlists = {}
-        self.__populate_library()
+        """Scan the Google Play Music library. An empty filesystem is filled
+        as the tracks come. Otherwise the new library is built next to the
+        live one, which is served until the new one replaces it at once."""
+        self.login()
+        with self.__lock:
+            log.info('Gathering track information...')
+            sync_time = time.time()
+            live = not self.tracks
+            index = self.__new_index(live)
+            tracks = []
+            for page in self.__get_all_songs():
+                self.__add_tracks(index, page, live)
+                tracks.extend(page)
+            self.stats.count('gmusicfs_api_calls_total', call='get_all_user_playlist_contents')
+            playlists = self.api.get_all_user_playlist_contents()
+            self.__finish_index(index, playlists)
+            
+            old = dict((track['id'], track) for track in self.metadata.load_tracks())
+            new = dict((track['id'], track) for track in tracks)
+            removed = [track_id for track_id in old if track_id not in new]
+            changed = [track for track_id, track in new.items() if old.get(track_id) != track]
+            added = sum(1 for track in changed if track['id'] not in old)
+            self.__index = index
+            
+            self.metadata.delete_tracks(removed)
+            self.metadata.save_tracks(changed)
+            self.metadata.save_playlists(playlists)
+            self.metadata.set('synced', repr(sync_time))
+            self.__rescan_status = "Rescanned on {}: {} added, {} removed, {} changed".format(
+                time.strftime('%Y-%m-%d %H:%M:%S'), added, len(removed), len(changed) - added)
+            log.info(self.__rescan_status)
+    
+    def request_rescan(self):
+        """Ask run_rescans for a rescan"""
+        self.__rescan_requested.set()
+    
+    def run_rescans(self, interval=None):
+        """Rescan the library every interval seconds, if any, and whenever
+        one is requested. Never returns."""
+        while True:
+            self.__rescan_requested.wait(interval)
+            self.__rescan_requested.clear()
+            try:
+                self.rescan()
+            except:
+                log.exception("Error rescanning the library")
+    
+    def __get_all_songs(self):
+        """Yield the tracks of the library, a page at a time when the API can"""
+        self.stats.count('gmusicfs_api_calls_total', call='get_all_songs')
+        try:
+            pages = self.api.get_all_songs(incremental=True)
+        except TypeError: # This gmusicapi returns all the tracks at once
+            pages = [self.api.get_all_songs()]
+        for page in pages:
+            yield page
+    
+    def sync(self):
+        """Apply the changes made to the library since the last sync. Like
+        a rescan, the library is built next to the live one, then replaces
+        it at once."""
+        synced = self.metadata.get('synced')
+        if synced is None:
+            return self.rescan()
+        
+        self.login()
+        sync_time = time.time()
+        since = datetime.datetime.utcfromtimestamp(float(synced))
+        try:
+            self.stats.count('gmusicfs_api_calls_total', call='get_all_songs')
+            changes = self.api.get_all_songs(updated_after=since, include_deleted=True)
+        except TypeError: # This gmusicapi can't list changes only
+            return self.rescan()
+        self.stats.count('gmusicfs_api_calls_total', call='get_all_user_playlist_contents')
+        playlists = self.api.get_all_user_playlist_contents()
+        
+        deleted = [track['id'] for track in changes if track.get('deleted')]
+        updated = [track for track in changes if not track.get('deleted')]
+        with self.__lock:
+            tracks = OrderedDict((track['id'], track) for track in self.metadata.load_tracks())
+            for track in deleted:
+                tracks.pop(track, None)
+            for track in updated:
+                tracks[track['id']] = track
+            index = self.__new_index(live=False)
+            self.__add_tracks(index, tracks.values(), live=False)
+            self.__finish_index(index, playlists)
+            self.__index = index
+        self.metadata.delete_tracks(deleted)
+        self.metadata.save_tracks(updated)
+        self.metadata.save_playlists(playlists)
+        self.metadata.set('synced', repr(sync_time))
+        log.info("Synced {} updated and {} deleted tracks ({} errors).".format(len(updated), len(deleted), index.errors))
 
+    def search(self, query):
+        """Return the SearchResults of the tracks matching query"""
+        return self.__index.search.search(query)
+    
     def get_stream_url(self, trackId):
-        url = self.api.get_stream_url(trackId)
+        url = self.stream_urls.get(trackId)
         return url
-        
-    def __populate_library(self):
-        log.info('Gathering track information...')
-        tracks = self.api.get_all_songs()
-        errors = 0
+    
+    def __get_stream_url(self, trackId):
+        self.stats.count('gmusicfs_api_calls_total', call='get_stream_url')
+        return self.api.get_stream_url(trackId)
+    
+    def get_album_info(self, albumId):
+        """Return the album info, waiting for the call fetching it if any"""
+        return self.__album_infos.get(albumId)
+    
+    def album_info_failed(self, albumId):
+        return time.time() - self.__album_info_failures.get(albumId, 0) < ALBUM_INFO_RETRY_DELAY
+    
+    def prefetch_album_info(self, albums=None):
+        """Fetch the album info of albums (all of them by default) in the background"""
+        if albums is None:
+            albums = self.albums.values()
+        for album in albums:
+            if not album.tracks_loaded and not self.album_info_failed(album.id):
+                self.__album_infos.submit(album.id)
+    
+    def get_art(self, url):
+        """Return album art, from the art cache when possible, or None
+        when it can not be downloaded"""
+        art = self.art.get(url)
+        if art is None and not self.__art_failed(url):
+            try:
+                art = self.__arts.get(url)
+            except:  # Logged by the prefetcher
+                pass
+        return art
+    
+    def has_art(self, url):
+        return self.art.has(url)
+    
+    def __art_failed(self, url):
+        return time.time() - self.__art_failures.get(url, 0) < ART_RETRY_DELAY
+    
+    def prefetch_art(self, albums=None):
+        """Download the art of albums (all of them by default) in the background"""
+        if albums is None:
+            albums = self.albums.values()
+        for album in albums:
+            url = album.art_url
+            if url and not self.art.has(url) and not self.__art_failed(url):
+                self.__arts.submit(url)
+    
+    def __fetch_art(self, url):
+        log.info("loading album art: {}".format(url))
+        try:
+            art = self.downloader.run(functools.partial(self.transport.fetch, url))
+        except:
+            self.__art_failures[url] = time.time()
+            raise
+        self.art.put(url, art)
+        return art
+    
+    def prefetch_upcoming(self, tracks):
+        """Prepare the tracks likely to be played next: their stream URL,
+        their tag and the first seconds of their audio. The preparation of
+        the tracks of the previous call is cancelled."""
+        if tracks == self.__upcoming_tracks:
+            return  # The same track was opened again
+        self.__upcoming_tracks = tracks
+        self.__generation += 1
+        for track in tracks:
+            self.__upcoming.submit((self.__generation, track))
+    
+    def __warm_upcoming(self, key):
+        generation, track = key
+        if generation == self.__generation:
+            track.render_tag()
+        stream = None
+        chunks = -(-UPCOMING_SECONDS * UPCOMING_BITRATE // 8 // CHUNK_SIZE)
+        for index in range(chunks):
+            if generation != self.__generation:  # Another track was opened since
+                self.stats.count('gmusicfs_upcoming_prefetches_total', outcome='cancelled')
+                return
+            if self.cache.has(track.id, index):
+                continue
+            if stream is None:
+                stream = self.__new_stream(track.id)
+            if not stream.read(index * CHUNK_SIZE, CHUNK_SIZE, PRIORITY_PREFETCH):
+                break  # The track is shorter than that
+        self.stats.count('gmusicfs_upcoming_prefetches_total', outcome='done')
+    
+    def prerender_tags(self):
+        """Render the tags of every track ahead of their first read"""
+        tracks = self.tracks.values()
+        rendered = size = 0
         for track in tracks:
             try:
-                log.debug('track = %s' % pp.pformat(track))
-                
-                if 'artistId' not in track:
-                    track['artistId'] = track['artist'] # if we don't have an artistID, use the name as the id
-                
-                artistId = track['artistId'][0]
-                if artistId not in self.__artists:
-                    self.__artists[artistId] = Artist(self, track)
-                    self.__artists_by_name[str(self.__artists[artistId])] = self.__artists[artistId]
-                artist = self.__artists[artistId]
-                
-                if 'albumId' not in track:
-                    track['albumId'] = track['title']
-                
-                albumId = track['albumId']
-                if albumId not in self.__albums:
-                    self.__albums[albumId] = Album(self, track)
-                    artist.add_album(self.__albums[albumId])
-                album = self.__albums[albumId]
-                
-                track = Track(self, track)
-                if track.id not in self.__tracks:
-                    self.__tracks[track.id] = track
-                    album.add_track(track)
+                size += len(track.render_tag())
+                rendered += 1
             except:
-                log.exception("Error loading track: {}".format(track))
-                errors += 1
-                
-        playlists = self.api.get_all_user_playlist_contents()
+                log.exception("Error rendering tag of {}".format(track.id))
+                continue
+            if rendered == min(TAG_SAMPLE, len(tracks)):
+                estimate = size * len(tracks) // rendered
+                if estimate > self.tags.max_size:
+                    log.warning("The tags of the {} tracks take about {} MiB, the tag cache is"
+                                " limited to {} MiB: raise --tagcachesize to keep them all".format(
+                                    len(tracks), estimate // 1024**2, self.tags.max_size // 1024**2))
+        log.info("Rendered {} tags".format(rendered))
+    
+    def exact_size(self, track):
+        """Size of the tag and audio of a track, None until it was computed"""
+        if not self.true_file_size:
+            return None
+        known = self.__exact_sizes.get(track.id)
+        if known and known[0] == track.tag_key():
+            return known[1]
+        return None
+    
+    def prefetch_sizes(self, tracks):
+        """Compute the exact size of tracks in the background"""
+        if not self.true_file_size:
+            return
+        for track in tracks:
+            if self.exact_size(track) is None:
+                self.__sizes.submit(track)
+    
+    def compute_sizes(self):
+        """Compute the exact size of every track, one at a time so listed
+        directories, submitted by prefetch_sizes, get the other workers"""
+        computed = 0
+        for track in self.tracks.values():
+            if self.exact_size(track) is not None:
+                continue
+            try:
+                self.__sizes.get(track)
+                computed += 1
+            except:
+                pass  # Logged by the prefetcher
+        log.info("Computed {} exact sizes".format(computed))
+    
+    def __compute_size(self, track):
+        tag_key = track.tag_key()
+        tag = track.render_tag()
+        length = self.cache.length(track.id)
+        if length is None:
+            stream = self.__new_stream(track.id)
+            length = stream.probe()
+            if length is None:
+                return None
+        size = len(tag) + length
+        self.__exact_sizes[track.id] = (tag_key, size)
+        self.metadata.save_size(track.id, tag_key, size)
+        return size
+    
+    def __new_stream(self, track_id):
+        return RangeStream(track_id, self.stream_urls, self.transport, self.downloader,
+                           self.cache, self.memory)
+    
+    def __fetch_album_info(self, albumId):
+        album_info = self.metadata.album_info(albumId)
+        if album_info is None:
+            self.stats.count('gmusicfs_api_calls_total', call='get_album_info')
+            try:
+                album_info = self.api.get_album_info(albumId)
+            except:
+                self.__album_info_failures[albumId] = time.time()
+                raise
+            self.metadata.save_album_info(albumId, album_info)
+        return album_info
+        
+    def __new_index(self, live):
+        """Return an empty library index, made the live one if asked"""
+        index = LibraryIndex()
+        self.__index_paths(index)
+        if live:
+            self.__index = index
+        return index
+    
+    def __add_tracks(self, index, tracks, live):
+        """Add tracks to an index, and to the filesystem if it is live"""
+        for data in tracks:
+            track = self.__add_track(index, data)
+            if track is None:
+                index.errors += 1
+            elif live:
+                self.__index_track(index.paths, track)
+        if live:
+            with self.__arrived:
+                self.__arrived.notify_all()
+    
+    def __finish_index(self, index, playlists):
+        index.errors += self.__load_playlists(index, playlists)
+        # Album directory names depend on tracks loaded after them:
+        self.__index_paths(index)
+        with self.__arrived:
+            self.__arrived.notify_all()
+        
+        log.info("Loaded {} tracks, {} albums, {} artists and {} playlists ({} errors).".format(len(index.tracks), len(index.albums), len(index.artists), len(index.playlists), index.errors))
+    
+    def __add_track(self, index, track):
+        """Add a track from its API data, returns None on errors"""
+        try:
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('track = %s' % pp.pformat(track))
+            
+            if 'artistId' not in track:
+                track['artistId'] = track['artist'] # if we don't have an artistID, use the name as the id
+            
+            artistId = track['artistId'][0]
+            artist = index.artists.get(artistId)
+            if artist is None:
+                artist = index.artists[artistId] = Artist(self, track)
+                index.artists_by_name[unicode(artist)] = artist
+            
+            if 'albumId' not in track:
+                track['albumId'] = track['title']
+            
+            albumId = track['albumId']
+            album = index.albums.get(albumId)
+            if album is None:
+                album = index.albums[albumId] = Album(self, track, artist)
+                artist.add_album(album)
+            
+            data, track = track, Track(self, track, album)
+            for key in ('storeId', 'nid'):
+                if key in data:
+                    index.store_ids[data[key]] = track.id
+            if track.id not in index.tracks:
+                index.tracks[track.id] = track
+                album.add_track(track)
+                index.search.add(track)
+                index.mtime = max(index.mtime, track.mtime)
+        except:
+            log.exception("Error loading track: {}".format(track))
+            return None
+        return track
+    
+    def __index_paths(self, index):
+        """Rebuild the path index of a library index"""
+        paths = PathIndex()
+        for path in BROWSE_DIRS:
+            paths.add_dir(path)
+        for name, artist in index.artists_by_name.items():
+            paths.add_dir(paths.join('/artists', name), artist)
+            for album in artist.albums.values():
+                tracks = album.loaded_tracks.values()
+                genres = set(track.genre for track in tracks if track.genre)
+                for album_path in self.__album_dirs(paths, album, genres):
+                    self.__add_album_dir(paths, album_path, album)
+        recent = heapq.nlargest(RECENT_TRACKS, (track for track in index.tracks.values() if track.ctime),
+                                key=lambda track: track.ctime)
+        for track in recent:
+            name = u'{} - {} - {}'.format(time.strftime('%Y-%m-%d', time.localtime(track.ctime)),
+                                          track.artist, track)
+            paths.add_file(paths.join('/recent', name), track)
+        for name, playlist in index.playlists.items():
+            playlist_path = paths.add_dir(paths.join('/playlists', name), playlist)
+            self.__index_tracks(playlist_path, playlist.tracks.values(), paths)
+        paths.add_dir(SEARCH_DIR)
+        paths.add_dir(CONTROL_DIR)
+        paths.add_file(STATS_PATH, self.__stats_file)
+        paths.add_file(RESCAN_PATH, self.__rescan_file)
+        index.paths = paths
+    
+    def __album_dirs(self, paths, album, genres):
+        """The directories listing an album: under its artist, in /albums,
+        in /years and in /genres for each of the genres"""
+        name = u'{} - {}'.format(album, album.artist)
+        dirs = [paths.join(paths.join('/artists', unicode(album.artist)), unicode(album)),
+                paths.join('/albums', name)]
+        if album.year:
+            dirs.append(paths.join(paths.join('/years', unicode(album.year)), name))
+        for genre in genres:
+            dirs.append(paths.join(paths.join('/genres', genre), name))
+        return dirs
+    
+    def __add_album_dir(self, paths, path, album):
+        """Add an album directory, unless it is there already"""
+        if paths.is_dir(path):
+            return
+        parent = path.rsplit('/', 1)[0]
+        if not paths.is_dir(parent):
+            paths.add_dir(parent)
+        paths.add_dir(path, album)
+    
+    def __index_track(self, paths, track):
+        """Add the album and artist directories of a track if needed"""
+        album = track.album
+        artist = album and album.artist
+        if not artist:
+            return
+        artist_path = paths.join('/artists', unicode(artist))
+        if not paths.is_dir(artist_path):
+            paths.add_dir(artist_path, artist)
+        for album_path in self.__album_dirs(paths, album, [track.genre] if track.genre else []):
+            self.__add_album_dir(paths, album_path, album)
+    
+    def __index_tracks(self, path, tracks, paths):
+        """Add tracks to a directory of the path index"""
+        for track in tracks:
+            paths.add_file(paths.join(path, unicode(track)), track)
+    
+    def __load_playlists(self, index, playlists):
+        """Replace the playlists of an index, returns the number of errors"""
+        errors = 0
+        loaded = {}
         for pl in playlists:
             if pl['name']:
                 try:
-                    self.__playlists[pl['name']] = Playlist(self, pl)
+                    loaded[pl['name']] = Playlist(self, pl, index)
                 except:
                     log.exception("Error loading playlist: {}".format(pl))
                     errors += 1
-        
-        log.info("Loaded {} tracks, {} albums, {} artists and {} playlists ({} errors).".format(len(self.__tracks), len(self.__albums), len(self.__artists), len(self.__playlists), errors))
+        index.playlists = loaded
+        return errors
 
     def cleanup(self):
-        pass
+        self.__album_infos.close()
+        self.__arts.close()
+        self.__sizes.close()
+        self.__upcoming.close()
+        self.stream_urls.close()
+        self.downloader.close()
+        self.transport.close()
+        log.info("{} downloads over {} connections, {:.1f}s spent connecting".format(
+            self.transport.requests, self.transport.connections, self.transport.connect_time))
+        self.metadata.close()
 
 class GMusicFS(LoggingMixIn, Operations):
     """Google Music Filesystem"""
 
     def __init__(self, path, username=None, password=None,
-                 true_file_size=False, verbose=0, lowercase=True):
+                 true_file_size=False, verbose=0, lowercase=True,
+                 cache_dir=DEFAULT_CACHE_DIR, cache_size=DEFAULT_CACHE_SIZE,
+                 memory_size=DEFAULT_MEMORY_SIZE, prefetch_albums=False,
+                 prerender_tags=False, timeout=DEFAULT_TIMEOUT,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, rescan_interval=0,
+                 upcoming_tracks=UPCOMING_TRACKS, tag_cache_size=DEFAULT_TAG_CACHE_SIZE):
         Operations.__init__(self)
+        self.__upcoming_tracks = upcoming_tracks
+        self.__prefetch_albums = prefetch_albums
+        self.__prerender_tags = prerender_tags
+        self.__rescan_interval = rescan_interval
 
-        artist = '/artists/(?P<artist>[^/]+)'
-
-        self.artist_dir = re.compile('^{artist}$'.format(
-            artist=artist))
-        self.artist_album_dir = re.compile('^{artist}/{album}$'.format(
-            artist=artist, album=ALBUM_REGEX))
-        self.artist_album_track = re.compile('^{artist}/{album}/{track}$'.format(
-            artist=artist, album=ALBUM_REGEX, track=TRACK_REGEX))
-
-        self.playlist_dir = re.compile('^/playlists/(?P<playlist>[^/]+)$')
-        #self.playlist_track = re.compile('^/playlists/(?P<playlist>[^/]+)/(?P<track>[^/]+\.mp3)$')
-        self.playlist_track = re.compile('^/playlists/(?P<playlist>[^/]+)/(?P<track>(?P<number>[0-9]+) - (?P<title>.*)\.mp3)$')
-
-        self.__opened_tracks = {}  # path -> urllib2_obj
+        self.__opened_tracks = {}  # fh -> track, or the object reading the handle
+        self.__opened_lock = threading.Lock()
+        self.__fh = itertools.count(1)
         
-        # Login to Google Play Music and parse the tracks:
+        # The library is loaded in the background once mounted, see init:
         self.library = MusicLibrary(username, password,
-                                    true_file_size=true_file_size, verbose=verbose)
+                                    true_file_size=true_file_size, verbose=verbose,
+                                    cache_dir=cache_dir, cache_size=cache_size,
+                                    memory_size=memory_size, timeout=timeout,
+                                    max_connections=max_connections,
+                                    tag_cache_size=tag_cache_size)
+        stats = self.library.stats
+        stats.describe('gmusicfs_operation_seconds', 'histogram', 'Latency of the FUSE operations')
+        stats.describe('gmusicfs_operation_errors_total', 'counter', 'FUSE operations that failed')
+        stats.register('gmusicfs_open_handles', 'gauge', 'Open file handles',
+                       lambda: len(self.__opened_tracks))
         log.info("Filesystem ready : %s" % path)
 
+    def __call__(self, op, *args):
+        start = time.time()
+        try:
+            if self.log.isEnabledFor(logging.DEBUG):
+                return LoggingMixIn.__call__(self, op, *args)
+            # LoggingMixIn formats every call, data included, even when disabled
+            return Operations.__call__(self, op, *args)
+        except:
+            self.library.stats.count('gmusicfs_operation_errors_total', operation=op)
+            raise
+        finally:
+            self.library.stats.observe('gmusicfs_operation_seconds', time.time() - start,
+                                       operation=op)
+
+    def init(self, path):
+        # Started once mounted, as the threads would not survive daemonizing
+        sync = threading.Thread(target=self.__sync_library, name='sync')
+        sync.daemon = True
+        sync.start()
+        rescan = threading.Thread(target=self.__rescan_library, name='rescan')
+        rescan.daemon = True
+        rescan.start()
+
+    def __sync_library(self):
+        try:
+            self.library.populate()
+        except:
+            log.exception("Error loading the library")
+        try:
+            self.library.sync()
+        except LoginException as e:
+            log.warning("{}, serving the library snapshot".format(e))
+        except:
+            log.exception("Error syncing the library")
+        if self.__prefetch_albums:
+            self.library.prefetch_album_info()
+            self.library.prefetch_art()
+        if self.__prerender_tags:
+            self.library.prerender_tags()
+        if self.library.true_file_size:
+            self.library.compute_sizes()
+
+    def __rescan_library(self):
+        self.library.wait()
+        self.library.run_rescans(self.__rescan_interval or None)
+
     def cleanup(self):
         self.library.cleanup()
 
+    def __lookup(self, path):
+        """Return the object named by path, raise ENOENT if there is none"""
+        if path.startswith(SEARCH_DIR + '/'):
+            return self.__lookup_search(path[len(SEARCH_DIR) + 1:])
+        paths = self.library.paths
+        try:
+            return paths.lookup(path)
+        except KeyError:
+            pass
+        # Only the directories under the browse roots fill in as the library
+        # loads, the others are complete from the start:
+        if not self.library.populated and '/' + path.split('/')[1] in BROWSE_DIRS \
+                and path.count('/') > 1:
+            # Wait for the entry, it may not be loaded yet:
+            if self.library.wait(path, LOOKUP_TIMEOUT):
+                return self.library.paths.lookup(path)
+            paths = self.library.paths
+        # The album info may list tracks that are not in the library, only
+        # fetch it for names of tracks, not for the files scanners probe:
+        parent, _, name = path.rpartition('/')
+        if not TRACK_NAME_REGEX.match(name):
+            raise FuseOSError(ENOENT)
+        album = paths.lookup(parent) if parent in paths else None
+        if isinstance(album, Album) and not album.tracks_loaded:
+            album.tracks  # Fetches the album info
+            if path in paths:
+                return paths.lookup(path)
+        raise FuseOSError(ENOENT)
+
+    def __lookup_search(self, path):
+        """/search/<query> lists the tracks matching query"""
+        query, _, name = path.partition('/')
+        results = self.library.search(query)
+        if not name:
+            return results
+        if '/' not in name and name in results.entries:
+            return results.entries[name]
+        raise FuseOSError(ENOENT)
+
     def getattr(self, path, fh=None):
         """Get information about a file or directory"""
-        artist_dir_m = self.artist_dir.match(path)
-        artist_album_dir_m = self.artist_album_dir.match(path)
-        artist_album_track_m = self.artist_album_track.match(path)
-        playlist_dir_m = self.playlist_dir.match(path)
-        playlist_track_m = self.playlist_track.match(path)
-
-        # Default to a directory
-        st = {
-            'st_mode': (S_IFDIR | 0o755),
-            'st_nlink': 2}
-        date = 0  # Make the date really old, so that cp -u works correctly.
-        st['st_ctime'] = st['st_mtime'] = st['st_atime'] = date
-
-        if path == '/':
-            pass
-        elif path == '/artists':
-            pass
-        elif path == '/playlists':
-            pass
-        elif artist_dir_m:
-            pass
-        elif artist_album_dir_m:
-            parts = artist_album_dir_m.groupdict()
-            artist = self.library.artists_by_name[parts['artist']]
-            album = artist.albums[parts['album']]
-            #st['st_size'] = len(artist.albums)
-            
-        elif artist_album_track_m:
-            parts = artist_album_track_m.groupdict()
-            artist = self.library.artists_by_name[parts['artist']]
-            album = artist.albums[parts['album']]
-            track = album.tracks[parts['title']]
-            return track.get_attr()
-            
-        elif playlist_dir_m:
-            pass
-            
-        elif playlist_track_m:
-            parts = playlist_track_m.groupdict()
-            playlist = self.library.playlists[parts['playlist']]
-            track = playlist.tracks[parts['title']]
-            return track.get_attr()
+        node = self.__lookup(path)
+        if isinstance(node, (Track, Cover, StatsFile, RescanFile)):
+            st = node.get_attr()
         else:
-            raise FuseOSError(ENOENT)
-            
+            st = {
+                'st_mode': (S_IFDIR | 0o755),
+                'st_nlink': 2}
+            date = node.mtime if isinstance(node, (Artist, Album, Playlist)) else self.library.mtime
+            st['st_ctime'] = st['st_mtime'] = st['st_atime'] = date
+        # Stable across rescans and mounts, with the use_ino option:
+        if isinstance(node, (Artist, Album, Track, Cover, Playlist)):
+            st['st_ino'] = node.inode
+        else:
+            st['st_ino'] = inode('path', path)
         return st
 
-    def open(self, path, fh):
-        #log.info("open: {} ({})".format(path, fh))
-        artist_album_track_m = self.artist_album_track.match(path)
-        playlist_track_m = self.playlist_track.match(path)
-        
-        if artist_album_track_m:
-            parts = artist_album_track_m.groupdict()
-            artist = self.library.artists_by_name[parts['artist']]
-            album = artist.albums[parts['album']]
-            track = album.tracks[parts['title']]
-        elif playlist_track_m:
-            parts = playlist_track_m.groupdict()
-            playlist = self.library.playlists[parts['playlist']]
-            track = playlist.tracks[parts['title']]
-        else:
-            RuntimeError('unexpected opening of path: %r' % path)
+    def open(self, path, fi):
+        #log.info("open: {} ({})".format(path, fi.flags))
+        track = self.__lookup(path)
+        if not isinstance(track, (Track, Cover, StatsFile, RescanFile)):
+            raise RuntimeError('unexpected opening of path: %r' % path)
+        if fi.flags & (os.O_WRONLY | os.O_RDWR):
+            # Only the rescan file can be written to, to request a rescan:
+            if not isinstance(track, RescanFile):
+                raise FuseOSError(EROFS)
+            self.library.request_rescan()
 
-        key = path + "-" + str(fh)
-        if not fh in self.__opened_tracks:
-            self.__opened_tracks[key] = [0, track]
-            
-        self.__opened_tracks[key][0] += 1
-            
-        return fh
+        # Every open gets its own handle, so concurrent readers never share
+        # one. Some files read each handle from its own object:
+        handle = track.open() or track
+        with self.__opened_lock:
+            fh = next(self.__fh)
+            self.__opened_tracks[fh] = handle
+        if isinstance(track, Track) and self.__upcoming_tracks:
+            self.library.prefetch_upcoming(self.__upcoming(path))
+        # The control files change all the time: always read them from
+        # here, never from the page cache or within a cached size
+        fi.direct_io = isinstance(track, (StatsFile, RescanFile))
+        fi.fh = fh
+        return 0
 
-    def release(self, path, fh):
-        #log.info("release: {} ({})".format(path, fh))
-        key = path + "-" + str(fh)
-        track = self.__opened_tracks.get(key, None)
+    def __upcoming(self, path):
+        """The tracks listed after path in its album or playlist directory,
+        the ones a player is likely to open next"""
+        parent, name = path.rsplit('/', 1)
+        paths = self.library.paths
+        if not isinstance(paths.lookup(parent) if parent in paths else None, (Album, Playlist)):
+            return []
+        names = paths.listdir(parent)
+        upcoming = []
+        for name in names[bisect.bisect_right(names, name):]:
+            node = paths.lookup(paths.join(parent, name))
+            if isinstance(node, Track):
+                upcoming.append(node)
+                if len(upcoming) == self.__upcoming_tracks:
+                    break
+        return upcoming
+
+    def release(self, path, fi):
+        #log.info("release: {} ({})".format(path, fi.fh))
+        with self.__opened_lock:
+            track = self.__opened_tracks.pop(fi.fh, None)
         if not track:
             raise RuntimeError('unexpected path: %r' % path)
-        track[0] -= 1
-        if not track[0]:
-            track[1].close()
-
-    def read(self, path, size, offset, fh):
-        #log.info("read: {} offset: {} size: {} ({})".format(path, offset, size, fh))
-        key = path + "-" + str(fh)
-        track = self.__opened_tracks.get(key, None)
+        track.close()
+
+    def read(self, path, size, offset, fi):
+        #log.info("read: {} offset: {} size: {} ({})".format(path, offset, size, fi.fh))
+        track = self.__opened_tracks.get(fi.fh, None)
         if track is None:
             raise RuntimeError('unexpected path: %r' % path)
             
-        return track[1].read(offset, size)
+        data = track.read(offset, size)
+        self.library.stats.count('gmusicfs_bytes_served_total', len(data))
+        return data
+
+    def write(self, path, data, offset, fi):
+        if not isinstance(self.__opened_tracks.get(fi.fh), RescanFile):
+            raise FuseOSError(EROFS)
+        return len(data)  # Its content is the rescan status, whatever is written
+
+    def truncate(self, path, length, fh=None):
+        if not isinstance(self.__lookup(path), RescanFile):
+            raise FuseOSError(EROFS)
 
     def readdir(self, path, fh):
-        artist_dir_m = self.artist_dir.match(path)
-        artist_album_dir_m = self.artist_album_dir.match(path)
-        playlist_dir_m = self.playlist_dir.match(path)
-        
-        if path == '/':
-            return ['.', '..', 'artists', 'playlists']
-            
-        elif path == '/artists':
-            return ['.', '..'] + self.library.artists_by_name.keys()
-            
-        elif path == '/playlists':
-            return ['.', '..'] + self.library.playlists.keys()
-            
-        elif artist_dir_m:
-            # Artist directory, lists albums.
-            parts = artist_dir_m.groupdict()
-            artist = self.library.artists_by_name[parts['artist']]
-            return ['.', '..'] + [str(album) for album in artist.albums.values()]
-            
-        elif artist_album_dir_m:
-            # Album directory, lists tracks.
-            parts = artist_album_dir_m.groupdict()
-            artist = self.library.artists_by_name[parts['artist']]
-            album = artist.albums[parts['album']]
-            return ['.', '..'] + [str(track) for track in album.tracks.values()]
-            
-        elif playlist_dir_m:
-            # Playlists directory, lists tracks.
-            parts = playlist_dir_m.groupdict()
-            playlist = self.library.playlists[parts['playlist']]
-            return ['.', '..'] + [str(track) for track in playlist.tracks.values()]
-            
-        return ['.', '..']
+        node = self.__lookup(path)
+        if isinstance(node, SearchResults):
+            return ['.', '..'] + node.entries.keys()
+        if not self.library.paths.is_dir(path):
+            raise FuseOSError(ENOTDIR)
+        if isinstance(node, Artist):
+            # The album directories are likely to be listed next:
+            self.library.prefetch_album_info(node.albums.values())
+            self.library.prefetch_art(node.albums.values())
+        elif isinstance(node, Album):
+            # Album directory, lists all the tracks of the album info.
+            node.tracks
+            # Its cover is listed once downloaded:
+            self.library.prefetch_art([node])
+            self.library.prefetch_sizes(node.loaded_tracks.values())
+        elif isinstance(node, Playlist):
+            self.library.prefetch_sizes(node.tracks.values())
+        return ['.', '..'] + self.library.paths.listdir(path)
 
 
 def main():
@@ -592,6 +1528,7 @@ def main():
     logging.getLogger('gmusicapi').setLevel(logging.WARNING)
     logging.getLogger('fuse').setLevel(logging.WARNING)
     logging.getLogger('requests.packages.urllib3').setLevel(logging.WARNING)
+    logging.getLogger('eyed3').setLevel(logging.WARNING)  # Logs every tag it renders
 
     parser = argparse.ArgumentParser(description='GMusicFS')
     parser.add_argument('mountpoint', help='The location to mount to')
@@ -602,8 +1539,8 @@ def main():
                         action='store_true', dest='verbose')
     parser.add_argument('-vv', '--veryverbose', help='Be very verbose',
                         action='store_true', dest='veryverbose')
-    parser.add_argument('-t', '--truefilesize', help='Report true filesizes'
-                        ' (slower directory reads)',
+    parser.add_argument('-t', '--truefilesize', help='Report exact file sizes, computed'
+                        ' in the background and estimated until then',
                         action='store_true', dest='true_file_size')
     parser.add_argument('--allow_other', help='Allow all system users access to files'
                         ' (Requires user_allow_other set in /etc/fuse.conf)',
@@ -616,6 +1553,45 @@ def main():
                         action='store', dest='gid')
     parser.add_argument('-l', '--lowercase', help='Convert all path elements to lowercase',
                         action='store_true', dest='lowercase')
+    parser.add_argument('-m', '--multithreaded', help='Serve several requests at once,'
+                        ' so a slow download does not block the whole filesystem',
+                        action='store_true', dest='multithreaded')
+    parser.add_argument('--cachedir', help='Where to keep downloaded audio and library metadata'
+                        ' (default: %(default)s)', default=DEFAULT_CACHE_DIR,
+                        action='store', dest='cache_dir')
+    parser.add_argument('--cachesize', help='Maximum size of the audio cache,'
+                        ' in MiB (default: %(default)s)', default=DEFAULT_CACHE_SIZE,
+                        type=int, action='store', dest='cache_size')
+    parser.add_argument('--memorysize', help='Maximum memory used to buffer the tracks'
+                        ' being played, in MiB (default: %(default)s)', default=DEFAULT_MEMORY_SIZE,
+                        type=int, action='store', dest='memory_size')
+    parser.add_argument('--tagcachesize', help='Maximum size of the rendered ID3 tags, album'
+                        ' art included, kept on disk, in MiB (default: %(default)s)',
+                        default=DEFAULT_TAG_CACHE_SIZE, type=int, action='store',
+                        dest='tag_cache_size')
+    parser.add_argument('--prefetchalbums', help='Fetch the info and art of every album in the'
+                        ' background, so album directories list instantly',
+                        action='store_true', dest='prefetch_albums')
+    parser.add_argument('--prerendertags', help='Render the ID3 tags of every track in the'
+                        ' background, so they are ready when a track is first read',
+                        action='store_true', dest='prerender_tags')
+    parser.add_argument('--timeout', help='Network timeout of the audio and art downloads,'
+                        ' in seconds (default: %(default)s)', default=DEFAULT_TIMEOUT,
+                        type=float, action='store', dest='timeout')
+    parser.add_argument('--maxconnections', help='Maximum number of concurrent audio and art'
+                        ' downloads (default: %(default)s)', default=DEFAULT_MAX_CONNECTIONS,
+                        type=int, action='store', dest='max_connections')
+    parser.add_argument('--rescan', help='Rescan the library every this many minutes, 0 to'
+                        ' only rescan when .gmusicfs/rescan is written to (default: %(default)s)',
+                        default=0, type=float, action='store', dest='rescan')
+    parser.add_argument('--kernelcache', help='Let the kernel cache the audio, attributes'
+                        ' and directory entries, so tracks read again do not go through'
+                        ' GMusicFS. Changes are seen after at most {} seconds, or the'
+                        ' --rescan interval if shorter'.format(KERNEL_CACHE_TIMEOUT),
+                        action='store_true', dest='kernel_cache')
+    parser.add_argument('--upcoming', help='When a track of an album or playlist is opened,'
+                        ' prepare this many of the next tracks for playback (default: %(default)s)',
+                        default=UPCOMING_TRACKS, type=int, action='store', dest='upcoming')
 
     args = parser.parse_args()
 
@@ -641,10 +1617,36 @@ def main():
         logging.getLogger('requests.packages.urllib3').setLevel(logging.WARNING)
         verbosity = 0
 
-    fs = GMusicFS(mountpoint, true_file_size=args.true_file_size, verbose=verbosity, lowercase=args.lowercase)
+    fs = GMusicFS(mountpoint, true_file_size=args.true_file_size, verbose=verbosity, lowercase=args.lowercase,
+                  cache_dir=os.path.abspath(os.path.expanduser(args.cache_dir)), cache_size=args.cache_size,
+                  memory_size=args.memory_size, prefetch_albums=args.prefetch_albums,
+                  prerender_tags=args.prerender_tags, timeout=args.timeout,
+                  max_connections=args.max_connections, rescan_interval=args.rescan * 60,
+                  upcoming_tracks=args.upcoming, tag_cache_size=args.tag_cache_size)
+    # Check the credentials before mounting. Offline, a library scanned
+    # before is still served from its snapshot.
+    try:
+        fs.library.login()
+    except Exception as e:
+        if not fs.library.has_snapshot:
+            fs.cleanup()
+            raise
+        log.warning("{}, mounting the library snapshot".format(e))
+    options = {}
+    if args.kernel_cache:
+        # auto_cache drops the cached pages of a track whose size or mtime
+        # changed, and cached attributes and entries expire before the next
+        # rescan is served:
+        timeout = KERNEL_CACHE_TIMEOUT
+        if args.rescan:
+            timeout = min(timeout, args.rescan * 60)
+        options = dict(auto_cache=True, attr_timeout=timeout, entry_timeout=timeout)
+    # Not mounted read-only, so that .gmusicfs/rescan can be written to,
+    # every other change fails with EROFS:
     try:
         FUSE(fs, mountpoint, foreground=args.foreground,
-                    ro=True, nothreads=True, allow_other=args.allow_other, allow_root=args.allow_root, uid=args.uid, gid=args.gid)
+                    nothreads=not args.multithreaded, allow_other=args.allow_other, allow_root=args.allow_root, uid=args.uid, gid=args.gid,
+                    use_ino=True, raw_fi=True, **options)
     finally:
         fs.cleanup()
 
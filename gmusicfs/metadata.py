@@ -0,0 +1,127 @@
+"""
+Local snapshot of the Google Music library metadata.
+
+The raw track and playlist dicts returned by the API are kept in a SQLite
+database, so a mount can load the library from disk and only ask Google
+Music for what changed since the last sync. Album infos are kept there
+too, for ALBUM_INFO_TTL seconds, and so are the exact file sizes of the
+tracks once they are known.
+"""
+
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+log = logging.getLogger('gmusicfs.metadata')
+
+SCHEMA_VERSION = '1'
+ALBUM_INFO_TTL = 30 * 24 * 3600
+
+
+class MetadataCache(object):
+    """SQLite store of the library metadata"""
+
+    def __init__(self, path):
+        self.__path = path
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.text_factory = str
+        with self.__lock, self.__db:
+            self.__db.execute('CREATE TABLE IF NOT EXISTS meta '
+                              '(key TEXT PRIMARY KEY, value TEXT)')
+            if self.__get('schema') != SCHEMA_VERSION:
+                self.__db.execute('DROP TABLE IF EXISTS tracks')
+                self.__db.execute('DROP TABLE IF EXISTS playlists')
+                self.__db.execute('DROP TABLE IF EXISTS album_info')
+                self.__db.execute('DROP TABLE IF EXISTS sizes')
+                self.__db.execute('DELETE FROM meta')
+            self.__db.execute('CREATE TABLE IF NOT EXISTS tracks '
+                              '(id TEXT PRIMARY KEY, data TEXT)')
+            self.__db.execute('CREATE TABLE IF NOT EXISTS playlists '
+                              '(id TEXT PRIMARY KEY, data TEXT)')
+            self.__db.execute('CREATE TABLE IF NOT EXISTS album_info '
+                              '(id TEXT PRIMARY KEY, fetched REAL, data TEXT)')
+            self.__db.execute('CREATE TABLE IF NOT EXISTS sizes '
+                              '(id TEXT PRIMARY KEY, tag TEXT, size INTEGER)')
+            self.__set('schema', SCHEMA_VERSION)
+
+    @property
+    def path(self):
+        return self.__path
+
+    def __get(self, key):
+        row = self.__db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def __set(self, key, value):
+        self.__db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def get(self, key, default=None):
+        with self.__lock:
+            value = self.__get(key)
+        return default if value is None else value
+
+    def set(self, key, value):
+        with self.__lock, self.__db:
+            self.__set(key, value)
+
+    def load_tracks(self):
+        """Return the raw track dicts of the snapshot"""
+        with self.__lock:
+            rows = self.__db.execute('SELECT data FROM tracks').fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def load_playlists(self):
+        """Return the raw playlist dicts of the snapshot"""
+        with self.__lock:
+            rows = self.__db.execute('SELECT data FROM playlists').fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def save_tracks(self, tracks, replace=False):
+        """Store raw track dicts, replacing the whole snapshot if asked"""
+        rows = [(track['id'], json.dumps(track)) for track in tracks]
+        with self.__lock, self.__db:
+            if replace:
+                self.__db.execute('DELETE FROM tracks')
+            self.__db.executemany('INSERT OR REPLACE INTO tracks VALUES (?, ?)', rows)
+
+    def delete_tracks(self, track_ids):
+        with self.__lock, self.__db:
+            self.__db.executemany('DELETE FROM tracks WHERE id = ?',
+                                  [(track_id,) for track_id in track_ids])
+
+    def save_playlists(self, playlists):
+        """Replace the stored playlists"""
+        rows = [(pl['id'], json.dumps(pl)) for pl in playlists]
+        with self.__lock, self.__db:
+            self.__db.execute('DELETE FROM playlists')
+            self.__db.executemany('INSERT INTO playlists VALUES (?, ?)', rows)
+
+    def album_info(self, album_id):
+        """Return a stored album info, None if unknown or too old"""
+        with self.__lock:
+            row = self.__db.execute('SELECT data FROM album_info WHERE id = ? AND fetched > ?',
+                                    (album_id, time.time() - ALBUM_INFO_TTL)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_album_info(self, album_id, album_info):
+        with self.__lock, self.__db:
+            self.__db.execute('INSERT OR REPLACE INTO album_info VALUES (?, ?, ?)',
+                              (album_id, time.time(), json.dumps(album_info)))
+
+    def load_sizes(self):
+        """Return the exact sizes of the tracks, as track id -> (tag key, size)"""
+        with self.__lock:
+            rows = self.__db.execute('SELECT id, tag, size FROM sizes').fetchall()
+        return dict((track_id, (tag, size)) for track_id, tag, size in rows)
+
+    def save_size(self, track_id, tag, size):
+        with self.__lock, self.__db:
+            self.__db.execute('INSERT OR REPLACE INTO sizes VALUES (?, ?, ?)',
+                              (track_id, tag, size))
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
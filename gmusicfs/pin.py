@@ -0,0 +1,210 @@
+#!/usr/bin/env python2
+"""
+Download artists, albums or playlists into the audio cache of gmusicfs,
+so they play from local storage once mounted.
+
+Tracks are downloaded in parallel, within a global bandwidth cap, and their
+ID3 tags rendered. Tracks already in the cache are skipped.
+"""
+
+import sys
+import time
+import logging
+import argparse
+import threading
+from multiprocessing.pool import ThreadPool
+
+from .cache import CHUNK_SIZE
+from .download import PRIORITY_PREFETCH
+from .gmusicfs import (MusicLibrary, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE,
+                       DEFAULT_TAG_CACHE_SIZE, DEFAULT_TIMEOUT)
+from .stream import RangeStream
+
+log = logging.getLogger('gmusicfs.pin')
+
+DEFAULT_JOBS = 4  # Tracks downloaded at a time
+READ_BLOCK = 4 * CHUNK_SIZE  # Bytes downloaded between two bandwidth checks
+
+
+class Throttle(object):
+    """Token bucket shared by the downloads, capping their total rate to
+    rate bytes per second (0 for no limit)"""
+
+    def __init__(self, rate):
+        self.__rate = float(rate)
+        self.__lock = threading.Lock()
+        self.__allowed = time.time()  # When the bytes taken so far are paid for
+
+    def take(self, length):
+        """Account for length bytes, waiting until the rate allows them"""
+        if not self.__rate:
+            return
+        with self.__lock:
+            now = time.time()
+            # Never bank more than a second of unused bandwidth:
+            self.__allowed = max(self.__allowed, now - 1) + length / self.__rate
+            delay = self.__allowed - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Pinner(object):
+    """Downloads tracks into the audio cache of a library"""
+
+    def __init__(self, library, jobs=DEFAULT_JOBS, bandwidth=0):
+        self.__library = library
+        self.__jobs = jobs
+        self.__throttle = Throttle(bandwidth)
+        self.__lock = threading.Lock()
+        self.__done = 0
+        self.__failed = 0
+        self.__bytes = 0
+        self.__total = 0
+
+    def select(self, artists=(), albums=(), playlists=()):
+        """The tracks of the named artists, albums ("artist/album") and
+        playlists, in order and without duplicates. Unknown names are
+        reported and ignored."""
+        library = self.__library
+        tracks = []
+        for name in artists:
+            artist = library.artists_by_name.get(name)
+            if artist is None:
+                log.error("No artist named {}".format(name))
+                continue
+            for album in artist.albums.values():
+                tracks.extend(self.__album_tracks(album))
+        for name in albums:
+            artist_name, _, title = name.partition('/')
+            artist = library.artists_by_name.get(artist_name)
+            found = [album for album in (artist.albums.values() if artist else [])
+                     if title in (album.title, unicode(album))]
+            if not found:
+                log.error("No album named {}".format(name))
+            for album in found:
+                tracks.extend(self.__album_tracks(album))
+        for name in playlists:
+            playlist = library.playlists.get(name)
+            if playlist is None:
+                log.error("No playlist named {}".format(name))
+                continue
+            tracks.extend(sorted(playlist.tracks.values(), key=unicode))
+        seen = set()
+        return [track for track in tracks
+                if track.id not in seen and not seen.add(track.id)]
+
+    def __album_tracks(self, album):
+        return sorted(album.tracks.values(), key=lambda track: (track.number, track.title))
+
+    def pin(self, tracks):
+        """Download the tracks missing from the cache, returns the number
+        of tracks that failed"""
+        cache = self.__library.cache
+        missing = [track for track in tracks if not cache.complete(track.id)]
+        log.info("{} tracks selected, {} already cached".format(
+            len(tracks), len(tracks) - len(missing)))
+        estimate = sum(track.get_attr()['st_size'] for track in missing)
+        if cache.size + estimate > cache.max_size:
+            log.warning("About {} MiB to download, the audio cache is limited to {} MiB:"
+                        " the least recently played tracks will be evicted, raise"
+                        " --cachesize to keep them all".format(
+                            estimate // 1024**2, cache.max_size // 1024**2))
+        self.__total = len(missing)
+        start = time.time()
+        pool = ThreadPool(self.__jobs)
+        try:
+            pool.map(self.__pin_track, missing, chunksize=1)
+        finally:
+            pool.terminate()
+        elapsed = time.time() - start
+        log.info("Downloaded {} tracks, {:.1f} MiB in {:.1f}s ({:.1f} MiB/s), {} failed".format(
+            self.__done, self.__bytes / 1024.0**2, elapsed,
+            self.__bytes / 1024.0**2 / max(elapsed, 0.001), self.__failed))
+        return self.__failed
+
+    def __pin_track(self, track):
+        library = self.__library
+        received = 0
+        try:
+            track.render_tag()
+            stream = RangeStream(track.id, library.stream_urls, library.transport,
+                                 library.downloader, library.cache, library.memory)
+            try:
+                while stream.length is None or received < stream.length:
+                    data = stream.read(received, READ_BLOCK, PRIORITY_PREFETCH)
+                    if not data:
+                        break
+                    received += len(data)
+                    self.__throttle.take(len(data))
+            finally:
+                stream.close()  # The cache has the chunks, free the memory
+        except:
+            log.exception("Error downloading {}".format(track.id))
+            with self.__lock:
+                self.__failed += 1
+            return
+        with self.__lock:
+            self.__done += 1
+            self.__bytes += received
+            done = self.__done + self.__failed
+        log.info(u"[{}/{}] {} - {} - {}".format(
+            done, self.__total, track.artist, track.album_title, track.title))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download tracks into the GMusicFS cache')
+    parser.add_argument('-a', '--artist', help='Download the albums of an artist',
+                        action='append', default=[], dest='artists')
+    parser.add_argument('-b', '--album', help='Download an album, named "artist/album"',
+                        action='append', default=[], dest='albums')
+    parser.add_argument('-p', '--playlist', help='Download the tracks of a playlist',
+                        action='append', default=[], dest='playlists')
+    parser.add_argument('-j', '--jobs', help='Tracks downloaded at a time'
+                        ' (default: %(default)s)', default=DEFAULT_JOBS,
+                        type=int, action='store', dest='jobs')
+    parser.add_argument('--bandwidth', help='Maximum total download rate, in KiB/s,'
+                        ' 0 for no limit (default: %(default)s)', default=0,
+                        type=int, action='store', dest='bandwidth')
+    parser.add_argument('--cachedir', help='Where to keep downloaded audio and library metadata'
+                        ' (default: %(default)s)', default=DEFAULT_CACHE_DIR,
+                        action='store', dest='cache_dir')
+    parser.add_argument('--cachesize', help='Maximum size of the audio cache,'
+                        ' in MiB (default: %(default)s)', default=DEFAULT_CACHE_SIZE,
+                        type=int, action='store', dest='cache_size')
+    parser.add_argument('--tagcachesize', help='Maximum size of the rendered ID3 tags,'
+                        ' in MiB (default: %(default)s)', default=DEFAULT_TAG_CACHE_SIZE,
+                        type=int, action='store', dest='tag_cache_size')
+    parser.add_argument('--timeout', help='Network timeout of the downloads,'
+                        ' in seconds (default: %(default)s)', default=DEFAULT_TIMEOUT,
+                        type=float, action='store', dest='timeout')
+    parser.add_argument('-v', '--verbose', help='Log more than the progress',
+                        action='store_true', dest='verbose')
+    args = parser.parse_args()
+    if not (args.artists or args.albums or args.playlists):
+        parser.error('nothing to download, give at least one artist, album or playlist')
+    # The library names are unicode:
+    encoding = sys.getfilesystemencoding() or 'utf-8'
+    for names in (args.artists, args.albums, args.playlists):
+        names[:] = [name.decode(encoding) for name in names]
+
+    logging.getLogger('gmusicfs').setLevel(logging.INFO if args.verbose else logging.WARNING)
+    log.setLevel(logging.INFO)
+    logging.getLogger('gmusicapi').setLevel(logging.WARNING)
+    logging.getLogger('requests.packages.urllib3').setLevel(logging.WARNING)
+    logging.getLogger('eyed3').setLevel(logging.WARNING)  # Logs every tag it renders
+
+    library = MusicLibrary(cache_dir=args.cache_dir, cache_size=args.cache_size,
+                           timeout=args.timeout, max_connections=args.jobs,
+                           tag_cache_size=args.tag_cache_size)
+    try:
+        library.populate()
+        library.sync()
+        pinner = Pinner(library, args.jobs, args.bandwidth * 1024)
+        tracks = pinner.select(args.artists, args.albums, args.playlists)
+        failed = pinner.pin(tracks)
+    finally:
+        library.cleanup()
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Deduplicated background calls for gmusicfs.
+
+A Prefetcher runs a function on a bounded pool of worker threads. Asking
+for a key that is already being fetched waits for the running call instead
+of starting a new one.
+"""
+
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger('gmusicfs.prefetch')
+
+
+class Call(object):
+    """Outcome of a background call. Unlike the AsyncResult of Python 2,
+    which wakes a single waiter, every thread waiting for it is woken."""
+
+    def __init__(self):
+        self.__done = threading.Event()
+        self.__value = None
+        self.__error = None
+
+    def set(self, value=None, error=None):
+        self.__value = value
+        self.__error = error
+        self.__done.set()
+
+    def ready(self):
+        return self.__done.is_set()
+
+    def get(self):
+        """Wait for the call, return its value or raise its exception"""
+        self.__done.wait()
+        if self.__error is not None:
+            raise self.__error
+        return self.__value
+
+
+class Prefetcher(object):
+    """Runs function(key) on a pool of workers, one call per key at a time"""
+
+    def __init__(self, function, workers):
+        self.__function = function
+        self.__workers = workers
+        self.__pool = None  # Created on first use, so it survives daemonizing
+        self.__pending = {}  # key -> Call
+        self.__lock = threading.Lock()
+
+    def submit(self, key):
+        """Start fetching key in the background, returns a Call"""
+        with self.__lock:
+            call = self.__pending.get(key)
+            if call is None:
+                if self.__pool is None:
+                    self.__pool = ThreadPool(self.__workers)
+                call = self.__pending[key] = Call()
+                self.__pool.apply_async(self.__run, (key, call))
+            return call
+
+    def get(self, key):
+        """Fetch key, or wait for the call already fetching it"""
+        return self.submit(key).get()
+
+    def __run(self, key, call):
+        try:
+            value = self.__function(key)
+        except Exception as e:
+            log.exception("Error fetching {}".format(key))
+            with self.__lock:
+                self.__pending.pop(key, None)
+            call.set(error=e)
+        else:
+            with self.__lock:
+                self.__pending.pop(key, None)
+            call.set(value)
+
+    def close(self):
+        if self.__pool is not None:
+            self.__pool.terminate()
@@ -0,0 +1,114 @@
+"""
+Inverted index of the tracks of a library, for the /search directory.
+
+Artists, album titles, track titles and genres are split in lowercase
+words, each pointing to the set of tracks containing it. A query matches
+the tracks containing, for each of its words, a word starting with it.
+"""
+
+import re
+import bisect
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger('gmusicfs.search')
+
+WORD_REGEX = re.compile(r'\w+', re.UNICODE)
+MAX_RESULTS = 1000  # Tracks listed in a search directory
+CACHED_QUERIES = 64
+
+
+def words(text):
+    if not text:
+        return []
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return WORD_REGEX.findall(text.lower())
+
+
+def track_words(track):
+    return set(words(track.artist) + words(track.album_title) +
+               words(track.title) + words(track.genre))
+
+
+class SearchResults(object):
+    """A search directory: the tracks matching a query, by file name"""
+    __slots__ = ('__query', '__entries')
+
+    def __init__(self, query, tracks):
+        self.__query = query
+        self.__entries = {}
+        for track in tracks:
+            name = u'{} - {} - {}'.format(track.artist, track.album_title, track).replace('/', '-')
+            if name in self.__entries:
+                name = u'{} ({}).mp3'.format(name[:-len('.mp3')], track.id)
+            self.__entries[name] = track
+
+    @property
+    def query(self):
+        return self.__query
+
+    @property
+    def entries(self):
+        return self.__entries
+
+
+class SearchIndex(object):
+    """Words of the tracks -> tracks"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__postings = {}  # word -> set of tracks
+        self.__words = None  # Sorted words, for prefix lookups, None when outdated
+        self.__results = OrderedDict()  # query -> SearchResults, oldest first
+
+    def add(self, track):
+        with self.__lock:
+            for word in track_words(track):
+                tracks = self.__postings.get(word)
+                if tracks is None:
+                    tracks = self.__postings[word] = set()
+                    self.__words = None
+                tracks.add(track)
+            self.__results.clear()
+
+    def search(self, query):
+        """Return the SearchResults of a query"""
+        with self.__lock:
+            results = self.__results.pop(query, None)
+            if results is None:
+                results = SearchResults(query, self.__match(words(query)))
+            self.__results[query] = results  # Most recently used
+            while len(self.__results) > CACHED_QUERIES:
+                self.__results.popitem(last=False)
+            return results
+
+    def __match(self, query_words):
+        """Tracks matching all the words, must be called with the lock held"""
+        if not query_words:
+            return []
+        if self.__words is None:
+            self.__words = sorted(self.__postings)
+        matches = None
+        # Rarest words first, so the intersection shrinks fast:
+        for tracks in sorted((self.__prefixed(word) for word in query_words), key=len):
+            matches = tracks if matches is None else matches & tracks
+            if not matches:
+                return []
+        tracks = sorted(matches, key=lambda track: (track.artist, track.album_title,
+                                                    track.number, track.title))
+        if len(tracks) > MAX_RESULTS:
+            log.info("{} tracks match {}, listing {}".format(
+                len(tracks), query_words, MAX_RESULTS))
+        return tracks[:MAX_RESULTS]
+
+    def __prefixed(self, prefix):
+        """Tracks containing a word starting with prefix"""
+        tracks = set()
+        start = bisect.bisect_left(self.__words, prefix)
+        for word in self.__words[start:]:
+            if not word.startswith(prefix):
+                break
+            tracks |= self.__postings[word]
+        return tracks
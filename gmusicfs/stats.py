@@ -0,0 +1,154 @@
+"""
+Runtime statistics of gmusicfs, in the Prometheus text format.
+
+Counters and latency histograms are updated as the filesystem runs. Values
+already tracked elsewhere, like the cache hit counts, are registered as
+functions and sampled when the statistics are rendered.
+"""
+
+import time
+import logging
+import threading
+from stat import S_IFREG
+
+log = logging.getLogger('gmusicfs.stats')
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+SNAPSHOT_LIFETIME = 1  # Seconds the size of a StatsFile is kept for
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"'))
+                          for name, value in labels) + '}'
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class Stats(object):
+    """Registry of the metrics of a mount"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__metrics = []  # (name, type, help), in rendering order
+        self.__values = {}  # name -> {labels: value or Histogram}
+        self.__samplers = {}  # name -> function returning the value
+
+    def describe(self, name, type, help):
+        """Declare a metric, once, before it is used"""
+        self.__metrics.append((name, type, help))
+        self.__values[name] = {}
+
+    def register(self, name, type, help, function):
+        """Declare a metric whose value is returned by function()"""
+        self.describe(name, type, help)
+        self.__samplers[name] = function
+
+    def count(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            values = self.__values[name]
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            values = self.__values[name]
+            histogram = values.get(key)
+            if histogram is None:
+                histogram = values[key] = Histogram()
+            histogram.observe(value)
+
+    def render(self):
+        lines = []
+        for name, type, help in self.__metrics:
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, type))
+            if name in self.__samplers:
+                try:
+                    lines.append('{} {}'.format(name, self.__samplers[name]()))
+                except:
+                    log.exception("Error sampling {}".format(name))
+                continue
+            with self.__lock:
+                values = sorted(self.__values[name].items())
+                if type == 'histogram':
+                    values = [(labels, (list(h.counts), h.sum, h.count))
+                              for labels, h in values]
+            for labels, value in values:
+                if type != 'histogram':
+                    lines.append('{}{} {}'.format(name, format_labels(labels), value))
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket in zip(LATENCY_BUCKETS, counts):
+                    cumulative += bucket
+                    lines.append('{}_bucket{} {}'.format(
+                        name, format_labels(labels + (('le', bound),)), cumulative))
+                lines.append('{}_bucket{} {}'.format(
+                    name, format_labels(labels + (('le', '+Inf'),)), count))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), repr(total)))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsFile(object):
+    """The statistics as a read-only file. Each handle reads them as they
+    were when it was opened. The rendering reported by get_attr is kept for
+    SNAPSHOT_LIFETIME seconds, so a listing does not render them for every
+    entry."""
+
+    def __init__(self, stats):
+        self.__stats = stats
+        self.__snapshot = ''
+        self.__rendered = 0
+
+    def __refresh(self):
+        if time.time() - self.__rendered > SNAPSHOT_LIFETIME:
+            self.__snapshot = self.__stats.render()
+            self.__rendered = time.time()
+        return self.__snapshot
+
+    def get_attr(self):
+        st = {}
+        st['st_mode'] = (S_IFREG | 0o444)
+        st['st_nlink'] = 1
+        st['st_size'] = len(self.__refresh())
+        st['st_ctime'] = st['st_mtime'] = st['st_atime'] = int(self.__rendered)
+        return st
+
+    def open(self):
+        """Return the handle to read from"""
+        return StatsSnapshot(self.__stats.render())
+
+
+class StatsSnapshot(object):
+    """A handle of a StatsFile"""
+    __slots__ = ('__data',)
+
+    def __init__(self, data):
+        self.__data = data
+
+    def read(self, offset, size):
+        return self.__data[offset:offset + size]
+
+    def close(self):
+        pass
@@ -0,0 +1,476 @@
+"""
+Random access to Google Music audio streams.
+
+A track's audio is addressed in CHUNK_SIZE chunks. Chunks are looked up in
+the memory cache shared by all streams, then in the disk cache, and only
+the missing ones are downloaded, with HTTP range requests.
+
+The downloads themselves run on a shared download.Downloader. While a
+track is read sequentially, ReadAhead schedules it there ahead of the
+reader in large blocks, so small reads are served from memory.
+
+All the open handles of a track share one StreamSession, from the
+Sessions registry: readers at different offsets each get their own
+ReadAhead, but a chunk is only downloaded once for all of them.
+
+Signed stream URLs are cached by StreamURLs until they expire. A download
+that gets interrupted is resumed from the last byte received. Downloads go
+through a shared transport.Transport, which keeps connections alive.
+"""
+
+import re
+import time
+import socket
+import httplib
+import logging
+import threading
+import urlparse
+import functools
+import collections
+
+from .cache import CHUNK_SIZE
+from .download import PRIORITY_READ, PRIORITY_READAHEAD, PRIORITY_PREFETCH
+from .prefetch import Call, Prefetcher
+from .transport import HTTPError
+
+log = logging.getLogger('gmusicfs.stream')
+
+CONTENT_RANGE_REGEX = re.compile(r'bytes (?:\d+-\d+|\*)/(\d+)')
+
+FETCH_ATTEMPTS = 3  # Tries to download a range, resuming where it stopped
+FETCH_BLOCK = 64 * 1024
+
+URL_WORKERS = 4  # Concurrent get_stream_url calls
+URL_LIFETIME = 60  # Seconds, for URLs without an expire parameter
+URL_EXPIRY_MARGIN = 30  # Stop using URLs this many seconds before they expire
+URL_REFRESH_MARGIN = 120  # Get a new URL in the background from then on
+
+SESSION_READERS = 4  # Readers at different offsets a session reads ahead for
+
+READAHEAD_BLOCK = 4 * CHUNK_SIZE
+READAHEAD_SIZE = 2 * READAHEAD_BLOCK  # Bytes buffered ahead of the reader
+
+
+class StreamURLs(object):
+    """Stream URLs of the tracks, reused until they expire"""
+
+    def __init__(self, get_url):
+        self.__get_url = get_url
+        self.__urls = {}  # track id -> (url, expiry time)
+        self.__fetcher = Prefetcher(self.__fetch, URL_WORKERS)
+
+    def get(self, track_id):
+        """Return a valid stream URL, asking for one only if needed"""
+        url, expires = self.__urls.get(track_id, (None, 0))
+        remaining = expires - time.time()
+        if remaining <= 0:
+            return self.__fetcher.get(track_id)
+        if remaining < URL_REFRESH_MARGIN:
+            self.__fetcher.submit(track_id)
+        return url
+
+    def prefetch(self, track_id):
+        """Get a stream URL in the background, unless one is still valid"""
+        if self.__urls.get(track_id, (None, 0))[1] - time.time() < URL_REFRESH_MARGIN:
+            self.__fetcher.submit(track_id)
+
+    def invalidate(self, track_id, url):
+        """Forget a URL the server refused"""
+        if self.__urls.get(track_id, (None, 0))[0] == url:
+            self.__urls.pop(track_id, None)
+
+    def __fetch(self, track_id):
+        url = self.__get_url(track_id)
+        query = urlparse.parse_qs(urlparse.urlparse(url).query)
+        try:
+            expires = int(query['expire'][0])
+        except (KeyError, ValueError):
+            expires = time.time() + URL_LIFETIME
+        now = time.time()
+        for old_id, (old_url, old_expires) in self.__urls.items():
+            if old_expires < now:
+                self.__urls.pop(old_id, None)
+        self.__urls[track_id] = (url, expires - URL_EXPIRY_MARGIN)
+        return url
+
+    def close(self):
+        self.__fetcher.close()
+
+
+class RangeStream(object):
+    """Audio of a track, fetched on demand by byte ranges"""
+
+    def __init__(self, track_id, urls, transport, downloader, cache, memory):
+        self.__track_id = track_id
+        self.__urls = urls
+        self.__transport = transport
+        self.__downloader = downloader
+        self.__cache = cache
+        self.__memory = memory  # The ranges fetched so far, while memory allows
+        self.__length = cache.length(track_id)
+        self.__lock = threading.Lock()
+        self.__pending = {}  # Chunk index -> Call of the download fetching it
+        self.__closed = False
+
+    @property
+    def length(self):
+        """Length of the audio in bytes, None until the server told us"""
+        return self.__length
+
+    def read(self, offset, size, priority=PRIORITY_READ):
+        """Read size bytes of audio starting at offset, downloading the
+        missing chunks with the given priority"""
+        chunks, end = self.__get_range(offset, size, priority)
+        skip = offset % CHUNK_SIZE
+        return "".join(chunks)[skip:skip + end - offset]
+
+    def fetch(self, offset, size, priority):
+        """Download the missing chunks of a range without reading it. Returns
+        how many bytes of the range the stream has, less than size at its end."""
+        chunks, end = self.__get_range(offset, size, priority)
+        available = offset // CHUNK_SIZE * CHUNK_SIZE + sum(len(chunk) for chunk in chunks)
+        return max(0, min(end, available) - offset)
+
+    def submit(self, offset, size, priority):
+        """Fetch in the background, returns the Call of the fetch"""
+        return self.__downloader.submit(functools.partial(self.fetch, offset, size, priority),
+                                        priority)
+
+    def __get_range(self, offset, size, priority):
+        """Return the chunks from the one holding offset, up to the one holding
+        the end of the range, and the end of the range within the stream"""
+        end = offset + size
+        if self.__length is not None:
+            end = min(end, self.__length)
+        if end <= offset:
+            return [], offset
+
+        first, last = offset // CHUNK_SIZE, (end - 1) // CHUNK_SIZE
+        chunks = []
+        index = first
+        while index <= last:
+            data = self.__get_chunk(index)
+            if data is None:
+                fetched = self.__downloader.run(
+                    functools.partial(self.__fetch_missing, index, last), priority)
+                if not fetched:  # Past the end of the stream
+                    break
+                chunks.extend(fetched)
+                index += len(fetched)
+                continue
+            chunks.append(data)
+            index += 1
+        return chunks, end
+
+    def cancel(self, call):
+        """Drop a fetch of submit that did not start yet"""
+        self.__downloader.cancel(call)
+
+    def probe(self, priority=PRIORITY_PREFETCH):
+        """Return the length of the audio, asking the server if it is unknown"""
+        if self.__length is None:
+            self.__downloader.run(self.__probe, priority)
+        return self.__length
+
+    def __probe(self):
+        response = self.__open(0, 0)
+        if response is not None:
+            try:
+                if response.status == 206:
+                    self.__set_length(response.getheader('Content-Range'))
+                    response.read()  # Keeps the connection reusable
+                else:  # The server ignored the range
+                    self.__set_length('bytes */{}'.format(response.getheader('Content-Length')))
+            finally:
+                response.close()
+
+    def __get_chunk(self, index):
+        data = self.__memory.get(self.__track_id, index)
+        if data is None:
+            data = self.__cache.get(self.__track_id, index)
+            if data is not None:
+                self.__memory.put(self.__track_id, index, data)
+        return data
+
+    def __has_chunk(self, index):
+        return (self.__memory.has(self.__track_id, index) or
+                self.__cache.has(self.__track_id, index))
+
+    def __fetch_missing(self, first, last):
+        """Download the run of missing chunks from first to at most last,
+        or wait for the reader already downloading first. Runs on a download
+        worker: only running downloads are waited for."""
+        while True:
+            with self.__lock:
+                data = self.__get_chunk(first)
+                if data is not None:
+                    return [data]
+                pending = self.__pending.get(first)
+                if pending is None:
+                    # Fetch the whole run of missing chunks with one request:
+                    last_missing = first
+                    while (last_missing < last and last_missing + 1 not in self.__pending and
+                           not self.__has_chunk(last_missing + 1)):
+                        last_missing += 1
+                    done = Call()
+                    for index in range(first, last_missing + 1):
+                        self.__pending[index] = done
+                    break
+            pending.get()  # Then look for the chunk again
+        try:
+            return self.__fetch(first, last_missing)
+        finally:
+            with self.__lock:
+                for index in range(first, last_missing + 1):
+                    self.__pending.pop(index, None)
+            done.set()
+
+    def __open(self, start, end):
+        """Request bytes start to end (inclusive) of the audio"""
+        for attempt in range(2):
+            url = self.__urls.get(self.__track_id)
+            headers = {'Range': 'bytes={}-{}'.format(start, end)}
+            try:
+                return self.__transport.request(url, headers)
+            except HTTPError as e:
+                if e.code == 416:  # Requested range not satisfiable
+                    self.__set_length(e.headers.get('Content-Range'))
+                    return None
+                if e.code in (403, 404, 410) and not attempt:
+                    log.info("Stream url of {} refused, getting a new one".format(self.__track_id))
+                    self.__urls.invalidate(self.__track_id, url)
+                    continue
+                raise
+
+    def __fetch(self, first, last):
+        """Download chunks first to last, keep and return them"""
+        start = first * CHUNK_SIZE
+        end = (last + 1) * CHUNK_SIZE - 1
+        log.debug("Fetching {} bytes {}-{}".format(self.__track_id, start, end))
+        data = []
+        received = 0
+        for attempt in range(FETCH_ATTEMPTS):
+            try:
+                response = self.__open(start + received, end)
+                if response is None:
+                    break
+                try:
+                    if response.status == 206:
+                        self.__set_length(response.getheader('Content-Range'))
+                    else:
+                        # The server ignored the range and sent the whole stream:
+                        whole = response.read()
+                        self.__length = len(whole)
+                        self.__cache.set_length(self.__track_id, self.__length)
+                        data.append(whole[start + received:end + 1])
+                        break
+                    while True:
+                        if self.__closed:
+                            return []  # Nobody is reading any more
+                        block = response.read(FETCH_BLOCK)
+                        if not block:
+                            break
+                        data.append(block)
+                        received += len(block)
+                finally:
+                    response.close()
+            except (socket.error, httplib.HTTPException) as e:
+                if attempt == FETCH_ATTEMPTS - 1:
+                    if not received:
+                        raise
+                    break  # Keep the chunks that made it
+                log.warning("Download of {} stopped at byte {}, resuming: {}".format(
+                    self.__track_id, start + received, e))
+                continue
+            wanted = end + 1 if self.__length is None else min(end + 1, self.__length)
+            if start + received >= wanted:
+                break
+            log.warning("Download of {} stopped at byte {}, resuming".format(
+                self.__track_id, start + received))
+        data = "".join(data)
+
+        chunks = []
+        for pos in range(0, len(data), CHUNK_SIZE):
+            index = first + pos // CHUNK_SIZE
+            chunk = data[pos:pos + CHUNK_SIZE]
+            if len(chunk) < CHUNK_SIZE and start + pos + len(chunk) != self.__length:
+                log.warning("Truncated download of {}".format(self.__track_id))
+                break  # Never keep a partial chunk
+            self.__memory.put(self.__track_id, index, chunk)
+            self.__cache.put(self.__track_id, index, chunk)
+            chunks.append(chunk)
+        return chunks
+
+    def close(self):
+        """Stop the downloads in progress and free the memory used by this stream"""
+        self.__closed = True
+        self.__memory.discard(self.__track_id)
+
+    def __set_length(self, content_range):
+        m = CONTENT_RANGE_REGEX.match(content_range or '')
+        if m and self.__length is None:
+            self.__length = int(m.group(1))
+            self.__cache.set_length(self.__track_id, self.__length)
+
+
+class ReadAhead(object):
+    """Streams a RangeStream ahead of a sequential reader.
+
+    The READAHEAD_SIZE bytes following the reader are downloaded in blocks of
+    READAHEAD_BLOCK bytes, scheduled on the downloader. Blocks end on chunk
+    boundaries, so two blocks never wait for the same chunk. A block only
+    downloads its chunks into the stream's memory, where they count against
+    its budget, and the reader reads them from there once the block is done.
+    A new block is only scheduled once the reader is past one, so a stream
+    that is not read any more stops downloading, without holding a thread."""
+
+    def __init__(self, stream, offset):
+        self.__stream = stream
+        self.__position = offset  # Offset of the next byte to be read
+        self.__blocks = collections.deque()  # (offset, size, Call) of the blocks ahead
+        self.__next = offset  # Offset of the next block to schedule
+        self.__stopped = False
+        for i in range(READAHEAD_SIZE // READAHEAD_BLOCK):
+            self.__schedule()
+
+    @property
+    def position(self):
+        return self.__position
+
+    def covers(self, offset):
+        """Tell if a read at offset can be served from the blocks ahead"""
+        return self.__position <= offset <= self.__position + READAHEAD_SIZE
+
+    def read(self, offset, size):
+        """Read from the blocks ahead, offset must be covered. Returns less
+        than size bytes at the end of the stream, or if a download failed."""
+        data = []
+        while size and self.__blocks:
+            start, length, call = self.__blocks[0]
+            try:
+                available = call.get()
+                end = start + available
+                piece = ''
+                if offset < end:
+                    # Served from memory, unless it was evicted meanwhile
+                    piece = self.__stream.read(offset, min(size, end - offset))
+            except Exception:
+                log.exception("Error reading ahead")
+                self.stop()
+                break
+            data.append(piece)
+            offset += len(piece)
+            size -= len(piece)
+            if offset >= end:  # Done with this block
+                self.__blocks.popleft()
+                if available < length:
+                    break  # End of the stream
+                self.__schedule()
+            elif size:
+                break  # The chunks could not be read again
+        self.__position = offset
+        return ''.join(data)
+
+    def stop(self):
+        """Drop the blocks not downloaded yet"""
+        self.__stopped = True
+        for start, length, call in self.__blocks:
+            self.__stream.cancel(call)
+        self.__blocks.clear()
+
+    def __schedule(self):
+        length = self.__stream.length
+        if self.__stopped or (length is not None and self.__next >= length):
+            return
+        size = READAHEAD_BLOCK - self.__next % CHUNK_SIZE
+        call = self.__stream.submit(self.__next, size, PRIORITY_READAHEAD)
+        self.__blocks.append((self.__next, size, call))
+        self.__next += size
+
+
+class StreamSession(object):
+    """The audio of a track, read through all of its open handles"""
+
+    def __init__(self, stream):
+        self.__stream = stream
+        self.__lock = threading.Lock()
+        self.__readaheads = []  # Idle ReadAheads, the most recently used last
+        self.handles = 0  # Maintained by Sessions
+
+    def read(self, offset, size):
+        """Read size bytes of audio at offset. Concurrent reads are served
+        by different ReadAheads, following their reader."""
+        with self.__lock:
+            readahead = None
+            for candidate in reversed(self.__readaheads):
+                if candidate.covers(offset):
+                    readahead = candidate
+                    self.__readaheads.remove(readahead)  # In use by this read
+                    break
+
+        data = ""
+        stream = self.__stream
+        if readahead:
+            data = readahead.read(offset, size)
+            if len(data) == size or readahead.position == stream.length:
+                self.__keep(readahead)
+                return data
+            # The read ahead failed, go on without it
+            readahead.stop()
+            offset += len(data)
+            size -= len(data)
+
+        # Random access: read directly, then stream ahead from there
+        data += stream.read(offset, size)
+        length = stream.length
+        if length is None or offset + size < length:
+            self.__keep(ReadAhead(stream, offset + size))
+        return data
+
+    def __keep(self, readahead):
+        with self.__lock:
+            self.__readaheads.append(readahead)
+            if len(self.__readaheads) > SESSION_READERS:
+                self.__readaheads.pop(0).stop()
+
+    def close(self):
+        with self.__lock:
+            readaheads, self.__readaheads = self.__readaheads, []
+        for readahead in readaheads:
+            readahead.stop()
+        self.__stream.close()
+
+
+class Sessions(object):
+    """The StreamSessions of the tracks being read, by track id. A session
+    lives as long as handles of its track are open."""
+
+    def __init__(self, new_stream):
+        self.__new_stream = new_stream  # track id -> RangeStream
+        self.__sessions = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__sessions)
+
+    def acquire(self, track_id):
+        """Return the session of a track, for a new handle"""
+        with self.__lock:
+            session = self.__sessions.get(track_id)
+            if session is None:
+                session = self.__sessions[track_id] = StreamSession(self.__new_stream(track_id))
+            session.handles += 1
+            return session
+
+    def release(self, track_id):
+        """Forget a handle, closing the session with the last one"""
+        with self.__lock:
+            session = self.__sessions.get(track_id)
+            if session is None:
+                return
+            session.handles -= 1
+            if session.handles > 0:
+                return
+            del self.__sessions[track_id]
+        log.info("Closing stream session of {}".format(track_id))
+        session.close()
@@ -0,0 +1,204 @@
+"""
+Pooled HTTP transport for the audio and art downloads of gmusicfs.
+
+Connections are kept alive and reused, in one pool per host, so only the
+first download from a host pays for the TCP and TLS handshakes. The number
+of requests in flight is capped, and every socket operation times out.
+"""
+
+import time
+import socket
+import httplib
+import logging
+import threading
+import urlparse
+
+log = logging.getLogger('gmusicfs.transport')
+
+DEFAULT_TIMEOUT = 30  # Seconds
+DEFAULT_MAX_CONNECTIONS = 16  # Requests in flight
+MAX_IDLE_PER_HOST = 4
+MAX_REDIRECTS = 5
+
+
+class HTTPError(Exception):
+    """The server answered with an error status"""
+
+    def __init__(self, url, code, headers):
+        Exception.__init__(self, 'HTTP Error {}: {}'.format(code, url))
+        self.url = url
+        self.code = code
+        self.headers = headers
+
+
+class Response(object):
+    """Response to a request. Its connection goes back to the pool once the
+    body is read and the response closed."""
+
+    def __init__(self, transport, key, connection, response):
+        self.__transport = transport
+        self.__key = key
+        self.__connection = connection
+        self.__response = response
+
+    @property
+    def status(self):
+        return self.__response.status
+
+    def getheader(self, name, default=None):
+        return self.__response.getheader(name, default)
+
+    def read(self, size=None):
+        if self.__response is None:
+            return ''
+        if size is None:
+            data = self.__response.read()
+        else:
+            data = self.__response.read(size)
+        self.__transport._received(len(data))
+        return data
+
+    def close(self):
+        if self.__response is None:
+            return
+        reusable = self.__response.isclosed() and not self.__response.will_close
+        self.__response.close()
+        self.__response = None
+        self.__transport._release(self.__key, self.__connection, reusable)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Transport(object):
+    """HTTP client with per-host pools of keep-alive connections"""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_connections=DEFAULT_MAX_CONNECTIONS):
+        self.__timeout = timeout
+        self.__slots = threading.BoundedSemaphore(max_connections)
+        self.__lock = threading.Lock()
+        self.__idle = {}  # (scheme, host, port) -> idle connections
+        self.__connections = 0  # Connections opened so far
+        self.__connect_time = 0.0  # Seconds spent opening them
+        self.__requests = 0
+        self.__bytes_received = 0
+
+    @property
+    def connections(self):
+        return self.__connections
+
+    @property
+    def connect_time(self):
+        return self.__connect_time
+
+    @property
+    def requests(self):
+        return self.__requests
+
+    @property
+    def bytes_received(self):
+        return self.__bytes_received
+
+    def request(self, url, headers=None, method='GET'):
+        """Send a request, following redirects. Returns a Response, which
+        must be closed, or raises HTTPError for error statuses."""
+        for redirect in range(MAX_REDIRECTS + 1):
+            response = self.__request(url, headers or {}, method)
+            if response.status not in (301, 302, 303, 307, 308):
+                break
+            location = response.getheader('location')
+            response.read()
+            response.close()
+            if not location:
+                raise HTTPError(url, response.status, {})
+            url = urlparse.urljoin(url, location)
+        if response.status >= 400:
+            error = HTTPError(url, response.status,
+                              {'Content-Range': response.getheader('content-range')})
+            response.read()
+            response.close()
+            raise error
+        return response
+
+    def fetch(self, url, headers=None):
+        """Download a whole resource"""
+        response = self.request(url, headers)
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+    def __request(self, url, headers, method):
+        parts = urlparse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        self.__slots.acquire()
+        try:
+            for attempt in range(2):
+                connection, reused = self.__acquire(key)
+                try:
+                    connection.request(method, path, headers=headers)
+                    response = connection.getresponse()
+                except (socket.error, httplib.HTTPException):
+                    connection.close()
+                    if reused and not attempt:
+                        continue  # The server closed an idle connection
+                    raise
+                with self.__lock:
+                    self.__requests += 1
+                return Response(self, key, connection, response)
+        except:
+            self.__slots.release()
+            raise
+
+    def __acquire(self, key):
+        """Return an idle connection to the host, or a new one"""
+        with self.__lock:
+            idle = self.__idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port = key
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(host, port, timeout=self.__timeout)
+        else:
+            connection = httplib.HTTPConnection(host, port, timeout=self.__timeout)
+        start = time.time()
+        connection.connect()
+        elapsed = time.time() - start
+        with self.__lock:
+            self.__connections += 1
+            self.__connect_time += elapsed
+        log.debug("Connected to {} in {:.3f}s".format(host, elapsed))
+        return connection, False
+
+    def _received(self, length):
+        """Called by Response.read"""
+        with self.__lock:
+            self.__bytes_received += length
+
+    def _release(self, key, connection, reusable):
+        """Called by Response.close"""
+        try:
+            if reusable:
+                with self.__lock:
+                    idle = self.__idle.setdefault(key, [])
+                    if len(idle) < MAX_IDLE_PER_HOST:
+                        idle.append(connection)
+                        return
+            connection.close()
+        finally:
+            self.__slots.release()
+
+    def close(self):
+        with self.__lock:
+            idle, self.__idle = self.__idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
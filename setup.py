@@ -19,5 +19,6 @@ setup(
     zip_safe=False,
     packages=['gmusicfs'],
     entry_points={
-        'console_scripts': ['gmusicfs=gmusicfs.gmusicfs:main']},
+        'console_scripts': ['gmusicfs=gmusicfs.gmusicfs:main',
+                            'gmusicfs-pin=gmusicfs.pin:main']},
 )